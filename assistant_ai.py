@@ -1,14 +1,28 @@
+import os
 import json
+import time
+import uuid
 import functools
 import sublime
 import sublime_plugin
 
-from .assistant_settings import AssistantAISettings, Endpoint, Prompt
+from .assistant_settings import AssistantAISettings, Endpoint, Prompt, PKG_NAME
 from .assistant_thread import AssistantThread
+from .assistant_http import pool
+from .assistant_dispatch import Dispatcher, HedgedRequest
+from .assistant_template import expand
+from .assistant_stats import stats
+try:
+    from .assistant_engine import AsyncEngine
+except (ImportError, SyntaxError):
+    # the Python 3.3 plugin host has no asyncio
+    AsyncEngine = None
 
 # The global scope ensures that the settings can
 # be easily accessed from within all the classes.
 settings = AssistantAISettings()
+engine = AsyncEngine() if AsyncEngine else None
+dispatcher = Dispatcher(settings, engine)
 VERSION_ASSISTANT_AI = "1.1.0"
 VERSION_ST = int(sublime.version())
 
@@ -18,6 +32,11 @@ def plugin_loaded():
     """
     global settings
     settings.load()
+    if settings.engine == 'asyncio':
+        if engine:
+            engine.start()
+        else:
+            print("AssistantAI: WARNING: the 'asyncio' engine needs the Python 3.8 plugin host, using threads.")
 
 def plugin_unloaded():
     """
@@ -25,6 +44,43 @@ def plugin_unloaded():
     """
     global settings
     settings.unload()
+    dispatcher.cancel_all()
+    pool.close_all()
+    if engine:
+        engine.stop()
+
+class StatusIndicator(object):
+    """
+    A single status bar indicator for all the requests in flight (i.e.: "3 running, 1 queued").
+    One timer updates it while there are running or queued requests, however many they are.
+    """
+    frequency_ms = 250
+    icon_progress_steps = "▁▂▃▄▅▆▇▆▅▄▃▂"  # Alternate progress icons: ▊▋▌▍▎▏▎▍▌▋▊▉
+
+    def __init__(self):
+        self.active = False
+        self.step = 0
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        sublime.set_timeout(self.update, 0)
+
+    def update(self):
+        running, queued = dispatcher.counts()
+        if not running and not queued:
+            self.active = False
+            return
+        progress = self.icon_progress_steps[self.step % len(self.icon_progress_steps)]
+        self.step += 1
+        msg = "AssistantAI is working {} {} running".format(progress, running)
+        if queued:
+            msg += ", {} queued".format(queued)
+        sublime.status_message(msg)
+        sublime.set_timeout(self.update, self.frequency_ms)
+
+indicator = StatusIndicator()
 
 class AssistantAiTextCommand(sublime_plugin.TextCommand):
     """
@@ -216,40 +272,58 @@ class AssistantAiTextCommand(sublime_plugin.TextCommand):
 class AssistantAiAsyncCommand(AssistantAiTextCommand):
     global settings
 
-    def handle_thread(self, thread, elapsed=0):
+    def handle_thread(self, thread):
         """
-        Recursive method for checking in on the async API fetcher
+        Called, in the main thread, as soon as the thread is done. Acts as per the prompt
+        command with the thread result, or resumes stacked prompts, and records its stats.
         """
-        frequency_ms = 250
-        seconds = int(elapsed / 1000)
-        timeout = thread.timeout
-        icon_warn = "⚠️"
-        icon_progress_steps = "▁▂▃▄▅▆▇▆▅▄▃▂"  # Alternate progress icons: ▊▋▌▍▎▏▎▍▌▋▊▉
-        # If we ran out of time, let user know, stop checking on the thread
-        if seconds > timeout:
-            msg = "AssistantAI: {} Query ran out of time! {}s".format(icon_warn, timeout)
-            sublime.status_message(msg)
-            return
-        # While the thread is running, show them some feedback,
-        # and keep checking on the thread
-        if thread.running:
-            step = seconds % len(icon_progress_steps)
-            progress = icon_progress_steps[step]
-            msg = "AssistantAI is working {} Timout in {}s".format(progress, timeout-seconds)
-            sublime.status_message(msg)
-            # Wait a second, then check on it again
-            self.run_in(self.handle_thread, delay=frequency_ms, thread=thread, elapsed=elapsed+frequency_ms)
+        try:
+            self.apply_result(thread)
+        finally:
+            self.record_stats(thread)
+
+    def record_stats(self, thread):
+        """
+        Records the timings and payload sizes of the request, with its total time up to now.
+        Cached results, and requests sent by another prompt, are not recorded.
+        """
+        if isinstance(thread, HedgedRequest):
+            thread = thread.winner or thread.primary
+        if 'ttfb' not in thread.metrics:
             return
+        metrics = dict(thread.metrics)
+        metrics['total'] = time.perf_counter() - thread.created
+        error = thread.result.get('error') if isinstance(thread.result, dict) else "No result."
+        stats.record("{}/{}".format(thread.endpoint.sid, thread.endpoint.eid), thread.prompt.pid, metrics, error)
+
+    def apply_result(self, thread):
+        """
+        Acts as per the prompt command with the thread result, or resumes stacked prompts.
+        """
+        icon_warn = "⚠️"
+        # the streamed text, if any, is already written. Close the stream.
+        self.close_stream(thread)
+        # other edits may have moved the region while waiting for the response
+        region = self.untrack_region(thread)
         # If we finished with no result, something is wrong
         if not thread.result:
             sublime.status_message("AssistantAI: {} Something is wrong with remote server - aborting".format(icon_warn))
             return
-        sublime.status_message("AssistantAI: Done!")
+        tokens = thread.result.get('tokens')
+        if tokens and 'actual' in tokens:
+            sublime.status_message("AssistantAI: Done! {} prompt tokens (~{} estimated).".format(
+                tokens['actual'], tokens['estimated']))
+        elif tokens:
+            sublime.status_message("AssistantAI: Done! ~{} prompt tokens.".format(tokens['estimated']))
+        else:
+            sublime.status_message("AssistantAI: Done!")
         # Collect the result and act as per command spec
         error = thread.result.get('error')
         if error:
             sublime.status_message("AsistantAI: {} {}".format(icon_warn, error))
             return
+        if thread.result.get('streamed'):
+            return
         # process stacked prompts if anything there
         if thread.stack:
             frame = thread.stack.pop()
@@ -274,11 +348,81 @@ class AssistantAiAsyncCommand(AssistantAiTextCommand):
             return
         # Get the command to exectue as per prompt specs, since there is nothin in stack to process
         sublime_command = thread.prompt.get_sublime_command()
+        start = time.perf_counter()
         self.view.run_command(sublime_command, {
-            "region": [thread.region.begin(), thread.region.end()],
+            "region": [region.begin(), region.end()],
             "text": output,
             "kwargs": thread.prompt.command
         })
+        source = thread.winner if isinstance(thread, HedgedRequest) else thread
+        if source:
+            source.metrics['apply'] = time.perf_counter() - start
+
+    def dispatch(self, thread):
+        """
+        Submits the thread to the dispatcher. When it's done, handle_thread is called right away.
+        """
+        def on_done(thread):
+            sublime.set_timeout(functools.partial(self.handle_thread, thread))
+        thread.callbacks.append(on_done)
+        if isinstance(thread, HedgedRequest):
+            thread.submit(dispatcher, owner=self.view.id())
+        else:
+            dispatcher.submit(thread, owner=self.view.id())
+        indicator.start()
+
+    def dispatch_batch(self, threads):
+        """
+        Submits the threads to the dispatcher, to be sent in batched requests.
+        Each thread is handled by handle_thread as soon as its batch is done.
+        """
+        def on_done(thread):
+            sublime.set_timeout(functools.partial(self.handle_thread, thread))
+        for thread in threads:
+            thread.callbacks.append(on_done)
+        dispatcher.submit_batch(threads, owner=self.view.id())
+        indicator.start()
+
+    def track_region(self, thread):
+        """
+        Tracks the thread region, so the result is applied where the region is when the response
+        arrives, even if other results or the user have edited the view meanwhile.
+        """
+        key = 'assistant_ai_region_{}'.format(id(thread))
+        self.view.add_regions(key, [thread.region], '', '', sublime.HIDDEN)
+
+    def untrack_region(self, thread):
+        """
+        Stops tracking the thread region, and returns its current position.
+        """
+        key = 'assistant_ai_region_{}'.format(id(thread))
+        regions = self.view.get_regions(key)
+        self.view.erase_regions(key)
+        return regions[0] if regions else thread.region
+
+    def open_stream(self, thread):
+        """
+        Prepares a StreamWriter so the text of a streamed response is written
+        into the thread region while it's being received.
+        """
+        indent = self.get_region_indentation([thread.region.begin(), thread.region.end()])
+        writer = StreamWriter(self.view, thread.region, thread.prompt.command, indent)
+        def on_chunk(text):
+            args = {'key': writer.key, 'text': text}
+            sublime.set_timeout(functools.partial(self.view.run_command, 'assistant_ai_stream_text', args))
+        thread.writer = writer
+        thread.on_chunk = on_chunk
+
+    def close_stream(self, thread):
+        """
+        Closes the StreamWriter of the thread, if any. Since the thread is done, all received text
+        is already written.
+        """
+        writer = getattr(thread, 'writer', None)
+        if not writer:
+            return
+        thread.writer = None
+        self.view.run_command('assistant_ai_stream_text', {'key': writer.key, 'close': True})
 
     def quick_panel_prompts(self, **kwargs):
         """
@@ -306,8 +450,8 @@ class AssistantAiAsyncCommand(AssistantAiTextCommand):
         str_kwargs = settings.ensure_dict_str_str(kwargs)
         for pid, prompt in prompts.items():
             ids.append(pid)
-            name = sublime.expand_variables(prompt.name, str_kwargs)
-            desc = sublime.expand_variables(prompt.description, str_kwargs)
+            name = expand(prompt.name, str_kwargs)
+            desc = expand(prompt.description, str_kwargs)
             items.append(["{} {}".format(prompt.icon, name), "{} [{}]".format(desc, pid.upper())])
         if not items:
             icon_warn = "⚠️"
@@ -472,17 +616,67 @@ class AssistantAiPromptCommand(AssistantAiAsyncCommand):
         if not endpoint:
             self.run_in(self.quick_panel_endpoints, **kwargs)
             return
-        # for each selected region, perform a request
+        # hedged prompts also send the request to alternate endpoints, and keep the fastest response
+        alternates = settings.get_alternate_endpoints(prompt, endpoint)
+        # endpoints accepting an array of inputs get the requests of many regions at once
+        batched = []
+        # for each selected region, perform a request. All are dispatched at once, and each result is
+        # applied when received, up to the concurrency limits of settings and servers.
         for region in self.view.sel():
             text, pre, post = self.get_text_context(region, prompt)
             if 'text' in required_inputs and len(text) < 1:
                 continue
-            # TODO: hande_thread is not blocking, so we don't take advantadge of multi selection here.
-            # BUG: when user selects multi text, the thread is overwritten. Complex fix ahead!
             stack = self.get_stack_from(kwargs)
             thread = AssistantThread(settings, prompt, endpoint, region, text, pre, post, stack, kwargs)
-            thread.start()
-            self.handle_thread(thread)
+            if alternates:
+                threads = [thread] + [AssistantThread(settings, prompt, ep, region, text, pre, post, stack, kwargs)
+                    for ep in alternates]
+                thread = HedgedRequest(threads, prompt.hedge)
+            elif endpoint.batch and not thread.stream:
+                self.track_region(thread)
+                batched.append(thread)
+                continue
+            # stacked prompts returns the text to the caller prompt, not to the view, and outputs other than
+            # the text as it is (i.e.: with an output template) are only known with the whole response
+            if thread.stream and not stack and thread.endpoint.output_is_text:
+                self.open_stream(thread)
+            self.track_region(thread)
+            self.dispatch(thread)
+        if batched:
+            self.dispatch_batch(batched)
+
+class AssistantAiCancelCommand(AssistantAiTextCommand):
+    global settings
+
+    def run(self, edit):
+        """
+        Cancels all running and queued requests of prompts invoked from the current view.
+        """
+        count = dispatcher.cancel_all(owner=self.view.id())
+        sublime.status_message("AssistantAI: {} request(s) cancelled.".format(count))
+
+class AssistantAiStatsCommand(AssistantAiTextCommand):
+    global settings
+
+    def run(self, edit, export=False):
+        """
+        Shows the p50/p95/p99 timings per phase, and payload sizes, of the requests per endpoint,
+        and the queue of each priority class, in an output panel.
+        With 'export', also writes the last requests to a JSON lines file.
+        """
+        report = "{}\n\n{}".format(stats.report(), dispatcher.report())
+        if export:
+            path = os.path.join(sublime.cache_path(), PKG_NAME)
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, 'stats.jsonl')
+            count = stats.export(path)
+            report = "{}\n{} request(s) exported to {}".format(report, count, path)
+            sublime.status_message("AssistantAI: {} request(s) exported to {}".format(count, path))
+        self.view.run_command("assistant_ai_output_panel", {
+            "region": None,
+            "text": report,
+            "kwargs": {'syntax': 'Plain Text', 'name': 'assistant_ai_stats'},
+        })
 
 class AssistantAiDumpCommand(AssistantAiTextCommand):
     global settings
@@ -505,6 +699,145 @@ class AssistantAiDumpCommand(AssistantAiTextCommand):
             "kwargs": {'syntax': 'JSON'},
         })
 
+class StreamWriter(object):
+    """
+    Writes the text of a streamed response, as it arrives, into the target of the prompt command.
+
+    The target region is tracked as a view region, so it's not misplaced by edits made while
+    the response is being received. The prompt command options (strip_output, new_line_before,
+    new_line_after, preserve_indentation) are applied as the text commands do with the whole text.
+    """
+    writers = {}
+
+    def __init__(self, view, region, command, indent=''):
+        self.key = 'assistant_ai_stream_{}'.format(uuid.uuid4())
+        self.view = view
+        self.command = command
+        self.cmd = command.get('cmd', 'replace')
+        if self.cmd not in ('replace', 'prepend', 'append', 'insert', 'output', 'create'):
+            self.cmd = 'replace'
+        text_cmd = self.cmd in ('replace', 'prepend', 'append')
+        self.strip = command.get('strip_output', True)
+        self.new_line_before = text_cmd and command.get('new_line_before', False)
+        self.new_line_after = text_cmd and command.get('new_line_after', False)
+        self.indent = indent if text_cmd and command.get('preserve_indentation', True) else None
+        self.target = None    # output panel or new view, once created
+        self.started = False  # some text was written
+        self.line_start = True
+        self.pending = ''     # trailing white space, written only if followed by more text
+        self.view.add_regions(self.key, [region], '', '', sublime.HIDDEN)
+        StreamWriter.writers[self.key] = self
+
+    def format(self, text, final=False):
+        """
+        Returns the given chunk of text ready to be written.
+        """
+        if self.strip:
+            text = self.pending + text
+            if not self.started:
+                text = text.lstrip()
+            if final:
+                text = ''
+            stripped = text.rstrip()
+            self.pending = text[len(stripped):]
+            text = stripped
+        if not self.started and text and self.new_line_before:
+            text = "\n" + text
+        if final and self.started and self.new_line_after:
+            text = text + "\n"
+        if self.indent is None:
+            return text
+        new = ''
+        for i, line in enumerate(text.split('\n')):
+            if i > 0:
+                new += (self.indent if self.line_start else '') + "\n"
+                self.line_start = True
+            if line:
+                new += (self.indent if self.line_start else '') + line
+                self.line_start = False
+        if final and self.started:
+            new += (self.indent if self.line_start else '') + "\n"
+        return new
+
+    def write(self, edit, text, final=False):
+        text = self.format(text, final)
+        if not text:
+            return
+        if self.cmd in ('output', 'create'):
+            if not self.target:
+                self.target = self.create_target()
+            self.target.run_command('append', {'characters': text})
+            self.started = True
+            return
+        regions = self.view.get_regions(self.key)
+        if not regions:
+            return
+        point = regions[0].begin() if self.started else self.start(edit, regions[0])
+        if point is None:
+            return
+        size = self.view.insert(edit, point, text)
+        self.view.add_regions(self.key, [sublime.Region(point + size)], '', '', sublime.HIDDEN)
+        self.started = True
+
+    def start(self, edit, region):
+        """
+        Prepares the region for the first chunk of text, and returns the point where to write it.
+        """
+        if self.cmd == 'replace':
+            self.view.erase(edit, region)
+            return region.begin()
+        if self.cmd == 'prepend':
+            return region.begin()
+        if self.cmd == 'append':
+            return region.end()
+        placeholder = self.command.get('placeholder', 'XXX')
+        match = self.view.find(placeholder, region.begin())
+        if region.contains(match.begin()) and region.contains(match.end()):
+            self.view.erase(edit, match)
+            return match.begin()
+        return None
+
+    def create_target(self):
+        win = self.view.window()
+        syntax = self.command.get('syntax', 'Markdown')
+        if self.cmd == 'output':
+            name = 'assistant_ai'
+            target = win.create_output_panel(name)
+            win.run_command("show_panel", {"panel": "output.{}".format(name)})
+        else:
+            target = win.new_file()
+        try:
+            syntax_list = sublime.find_syntax_by_name(syntax)
+            if len(syntax_list) > 0:
+                target.assign_syntax(syntax_list[0])
+        except AttributeError:
+            pass
+        return target
+
+    def close(self, edit):
+        self.write(edit, '', final=True)
+        self.view.erase_regions(self.key)
+        del(StreamWriter.writers[self.key])
+
+class AssistantAiStreamTextCommand(AssistantAiTextCommand):
+    def run(self, edit, key, text='', close=False):
+        """
+        Writes a chunk of a streamed response using its StreamWriter.
+
+        Parameters:
+        edit (Object) : An edit object created to track changes in the view.
+        key (str) : The key identifying the StreamWriter.
+        text (str) : The received text.
+        close (bool) : Whether the stream is completed.
+        """
+        writer = StreamWriter.writers.get(key)
+        if not writer:
+            return
+        if text:
+            writer.write(edit, text)
+        if close:
+            writer.close(edit)
+
 class AssistantAiReplaceTextCommand(AssistantAiTextCommand):
     def run(self, edit, region, text, kwargs):
         """
@@ -630,14 +963,15 @@ class AssistantAiOutputPanelCommand(AssistantAiTextCommand):
         - edit: The sublime edit object.
         - region: The region object.
         - text: The text to display.
-        - kwargs: The optional arguments with 2 keys:
+        - kwargs: The optional arguments with 3 keys:
                 * strip_output: A boolean which determines whether or not to strip the trailing or leading white spaces.
                 * syntax: A string which determines the syntax of the text, defaulting to Markdown.
+                * name: The name of the output panel, defaulting to 'assistant_ai'.
         """
         if kwargs.get('strip_output', True):
             text = text.strip()
         syntax = kwargs.get('syntax', 'Markdown')
-        name = 'assistant_ai'
+        name = kwargs.get('name', 'assistant_ai')
         self.output_panel = self.view.window().create_output_panel(name)
         try:
             syntax_list = sublime.find_syntax_by_name(syntax)
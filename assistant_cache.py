@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+def fingerprint(endpoint, resource, query, data):
+    """
+    Returns a hash identifying a request: the endpoint, the resolved resource and query, and the payload.
+    """
+    key = json.dumps([endpoint.sid, endpoint.eid, endpoint.url, endpoint.method, resource, query, data],
+        sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class ResponseCache(object):
+    """
+    A two tier cache of parsed responses, keyed by request fingerprint.
+
+    The first tier is an in-memory LRU bounded in number of items. The optional second tier
+    stores responses as JSON files in the Sublime Text cache path, so they survive restarts.
+    All entries expire after their TTL (seconds).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (expires_at, result)
+        self.size = 256
+        self.ttl = 3600
+        self.path = None
+        self.disk_size = 1024
+
+    def configure(self, options, path=None):
+        """
+        Sets the cache limits from the 'cache' general setting.
+
+        Args:
+            options (dict): 'size' (items in memory), 'ttl' (default seconds), 'disk' (bool) and
+                'disk_size' (files in disk).
+            path (str): The directory for the disk tier.
+        """
+        self.size = options.get('size', 256)
+        self.ttl = options.get('ttl', 3600)
+        self.disk_size = options.get('disk_size', 1024)
+        self.path = path if options.get('disk', False) else None
+        with self.lock:
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns the cached result for the key, or None if not cached or expired.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    return entry[1]
+                del(self.memory[key])
+        entry = self.read(key)
+        if not entry:
+            return None
+        if entry[0] <= now:
+            self.remove(key)
+            return None
+        self.remember(key, entry)
+        return entry[1]
+
+    def put(self, key, result, ttl=None):
+        """
+        Caches the result for the key, for ttl seconds (or the default TTL).
+        """
+        ttl = ttl if ttl else self.ttl
+        entry = (time.time() + ttl, result)
+        self.remember(key, entry)
+        self.write(key, entry)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if not self.path or not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            self.remove(name[:-len('.json')])
+
+    def remember(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def file_for(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def read(self, key):
+        if not self.path:
+            return None
+        try:
+            with open(self.file_for(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return (data['expires_at'], data['result'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, key, entry):
+        if not self.path:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = self.file_for(key) + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': entry[0], 'result': entry[1]}, f)
+            os.replace(tmp, self.file_for(key))
+            self.prune()
+        except (OSError, TypeError, ValueError) as e:
+            print("AssistantAI: WARNING: can't write response to the disk cache: {}".format(e))
+
+    def remove(self, key):
+        if not self.path:
+            return
+        try:
+            os.remove(self.file_for(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        """
+        Removes the oldest files of the disk tier when it has more than disk_size files.
+        """
+        files = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.json')]
+        if len(files) <= self.disk_size:
+            return
+        files.sort(key=os.path.getmtime)
+        for file in files[:len(files) - self.disk_size]:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+# The global cache used by all threads.
+cache = ResponseCache()
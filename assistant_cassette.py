@@ -0,0 +1,225 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+
+def request_key(endpoint, method, resource, data):
+    """
+    Returns a hash identifying a request in a cassette: the endpoint, the resolved resource and the payload.
+    Unlike the cache fingerprint, the server URL is not part of it, so cassettes replay against any URL.
+    """
+    key = json.dumps([endpoint.sid, endpoint.eid, method, resource, data], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class Cassette(object):
+    """
+    Records the responses of real requests to a file, and replays them offline.
+
+    A cassette is a gzipped JSON lines file, with one interaction per line: the request (endpoint, prompt,
+    resource and payload, but no headers, so no credentials), and the response status, headers and body
+    chunks, each with the seconds waited for it. Streamed responses keep their chunk boundaries.
+
+    When replaying, responses are matched by request_key. Identical requests get the recorded responses
+    in order, repeating the last one when exhausted. Waits are divided by 'speed' (0 doesn't wait at all).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None  # None, 'record' or 'replay'
+        self.path = None
+        self.speed = 1.0
+        self.interactions = {}  # key -> [interactions]
+        self.played = {}        # key -> interactions replayed
+
+    def configure(self, options, path=None):
+        """
+        Sets the cassette from the 'cassette' general setting.
+
+        Args:
+            options (dict): 'mode' ('record', 'replay', or none to disable it), 'path' (the file, default to
+                the given one), and 'speed' (of the replay, 1 is the original speed).
+            path (str): The default file of the cassette.
+        """
+        mode = options.get('mode')
+        if mode not in (None, 'record', 'replay'):
+            print("AssistantAI: WARNING: unknown cassette mode '{}'.".format(mode))
+            mode = None
+        path = os.path.expanduser(options.get('path') or path or '')
+        with self.lock:
+            self.mode = mode if path else None
+            self.path = path
+            self.speed = max(0.0, float(options.get('speed', 1.0)))
+            self.interactions = {}
+            self.played = {}
+        if self.mode == 'replay':
+            self.load()
+
+    def load(self):
+        interactions = {}
+        count = 0
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    interaction = json.loads(line)
+                    interactions.setdefault(interaction['key'], []).append(interaction)
+                    count += 1
+        except (OSError, EOFError, ValueError) as e:
+            print("AssistantAI: WARNING: can't load the cassette {}: {}".format(self.path, e))
+        with self.lock:
+            self.interactions = interactions
+        print("AssistantAI: Replaying {} response(s) from {}.".format(count, self.path))
+
+    def add(self, interaction):
+        """
+        Appends a recorded interaction to the cassette file.
+        """
+        line = json.dumps(interaction, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.mode != 'record':
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # each append is a gzip member, read back as one stream
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(line)
+
+    def record(self, response, request, ttfb):
+        """
+        Returns the response wrapped to record its body as it's read. The interaction is added
+        to the cassette once the body is completely read.
+        """
+        return RecordingResponse(self, response, request, ttfb)
+
+    def replay(self, request, wait=time.sleep):
+        """
+        Returns the recorded response for the request, waiting its original time to first byte.
+
+        Args:
+            request (dict): The request, as passed to record.
+            wait (callable): Called with the seconds to wait. Returning True aborts the replay (i.e.: cancelled).
+
+        Raises:
+            LookupError: If the request is not in the cassette.
+        """
+        key = request['key']
+        with self.lock:
+            interactions = self.interactions.get(key)
+            if not interactions:
+                raise LookupError("The request to '{}' is not in the cassette {}.".format(
+                    request.get('endpoint'), self.path))
+            played = self.played.get(key, 0)
+            self.played[key] = played + 1
+            interaction = interactions[min(played, len(interactions) - 1)]
+        response = ReplayResponse(interaction, self.speed, wait)
+        response.delay(interaction.get('ttfb', 0))
+        return response
+
+class RecordingResponse(object):
+    """
+    Wraps an http.client.HTTPResponse, keeping each chunk read with the time waited for it.
+    """
+    def __init__(self, cassette, response, request, ttfb):
+        self.cassette = cassette
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.will_close = response.will_close
+        self.interaction = {
+            'key': request['key'],
+            'request': request,
+            'ttfb': ttfb,
+            'status': response.status,
+            'reason': response.reason,
+            'headers': response.getheaders(),
+            'chunks': [],
+        }
+        self.last = time.perf_counter()
+        self.done = False
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def read(self, size=-1):
+        return self.keep(self.response.read(size))
+
+    def readline(self, size=-1):
+        return self.keep(self.response.readline(size))
+
+    def keep(self, chunk):
+        now = time.perf_counter()
+        if chunk:
+            # bytes as latin-1 chars, which JSON keeps as they are if ASCII
+            self.interaction['chunks'].append([round(now - self.last, 4), chunk.decode('latin-1')])
+        elif not self.done:
+            self.done = True
+            self.cassette.add(self.interaction)
+        self.last = now
+        return chunk
+
+class ReplayResponse(object):
+    """
+    A recorded response, read as an http.client.HTTPResponse. Each chunk is returned after its recorded wait.
+    """
+    def __init__(self, interaction, speed, wait):
+        self.status = interaction['status']
+        self.reason = interaction.get('reason', '')
+        self.will_close = False
+        self.headers = [tuple(header) for header in interaction.get('headers', [])]
+        self.chunks = interaction.get('chunks', [])
+        self.speed = speed
+        self.wait = wait
+        self.index = 0
+        self.buf = b''
+        self.aborted = False
+
+    def getheader(self, name, default=None):
+        values = [v for k, v in self.headers if k.lower() == name.lower()]
+        return ', '.join(values) if values else default
+
+    def getheaders(self):
+        return list(self.headers)
+
+    def delay(self, seconds):
+        if self.speed and seconds > 0 and not self.aborted:
+            self.aborted = bool(self.wait(seconds / self.speed))
+
+    def fill(self):
+        """
+        Moves the next chunk to the buffer, after its wait. Returns False at the end of the body.
+        """
+        if self.aborted or self.index >= len(self.chunks):
+            return False
+        seconds, data = self.chunks[self.index]
+        self.index += 1
+        self.delay(seconds)
+        self.buf += data.encode('latin-1')
+        return not self.aborted
+
+    def read(self, size=-1):
+        if not self.buf:
+            self.fill()
+        if size is None or size < 0:
+            while self.fill():
+                pass
+            size = len(self.buf)
+        chunk, self.buf = self.buf[:size], self.buf[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buf and self.fill():
+            pass
+        end = self.buf.find(b'\n') + 1 or len(self.buf)
+        if size is not None and 0 <= size < end:
+            end = size
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+# The global cassette of all threads.
+cassette = Cassette()
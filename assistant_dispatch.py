@@ -0,0 +1,382 @@
+import time
+import threading
+from collections import deque
+from .assistant_cache import fingerprint
+from .assistant_ratelimit import limiter_for
+from .assistant_thread import AssistantBatchThread
+from .assistant_stats import Histogram, format_seconds
+
+# Classes of requests, from the highest priority to the lowest.
+PRIORITIES = ['interactive', 'chained', 'background']
+
+class Dispatcher(object):
+    """
+    Starts the threads of all prompts, bounding how many requests run concurrently.
+
+    There is a global limit ('max_requests' setting), and a limit per server (its 'max_connections').
+    Threads exceeding any limit are queued, and started in order as soon as running ones finish.
+    Servers with a 'rate_limit' keep their threads queued until their rate allows to start them.
+
+    Each thread has a priority class (see PRIORITIES): prompts invoked by the user are 'interactive',
+    prompts invoked by other prompts (i.e.: 'list_from_prompt' inputs) are 'chained', and prompts with
+    "priority": "background" are 'background'. Queued threads of a higher class start first, and each
+    class has requests reserved ('reserved_requests' setting) that other classes can't take, so a prompt
+    invoked by the user doesn't wait behind many background requests. Likewise, each class with requests
+    reserved has one of the 'max_connections' of each server reserved.
+
+    Identical requests (same fingerprint) submitted while one is queued or running are not sent
+    again. They wait for the one in flight, and get its result.
+
+    Threads are started, each sending its request, unless the 'engine' setting is 'asyncio' and an
+    engine is given: then the engine sends the requests of all threads from its event loop.
+    """
+    def __init__(self, settings, engine=None):
+        self.settings = settings
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.queues = dict((priority, deque()) for priority in PRIORITIES)
+        self.waits = dict((priority, Histogram()) for priority in PRIORITIES)  # seconds queued
+        self.running = set()
+        self.inflight = {}   # fingerprint -> thread sending the request
+        self.followers = {}  # fingerprint -> threads waiting for the one in flight
+        self.timer = None    # schedules again when rate limits allow it
+        self.timer_at = 0
+
+    def submit(self, thread, owner=None, priority=None):
+        """
+        Queues the thread, and starts it right away if limits allow it.
+        If an identical request is in flight, the thread will get its result instead.
+
+        The owner (i.e.: the view id) identifies the threads to cancel with cancel_all.
+        The priority overrides the class of the thread.
+        """
+        key = fingerprint(thread.endpoint, thread.resource, thread.query, thread.data)
+        thread.fingerprint = key
+        thread.owner = owner
+        thread.submitted = time.perf_counter()
+        if priority:
+            thread.priority = priority
+        if thread.priority not in PRIORITIES:
+            thread.priority = 'interactive'
+        thread.callbacks.append(self.finished)
+        with self.lock:
+            leader = self.inflight.get(key)
+            if leader:
+                thread.queued = leader.queued
+                thread.running = leader.running
+                self.followers[key].append(thread)
+                # a queued request waited by a higher class is promoted to it
+                if leader.queued and PRIORITIES.index(thread.priority) < PRIORITIES.index(leader.priority):
+                    self.queues[leader.priority].remove(leader)
+                    leader.priority = thread.priority
+                    self.queues[leader.priority].append(leader)
+                    self.schedule_in(0)
+                return
+            thread.queued = True
+            self.inflight[key] = thread
+            self.followers[key] = []
+            self.queues[thread.priority].append(thread)
+        self.schedule()
+
+    def submit_batch(self, threads, owner=None):
+        """
+        Submits the threads, packing the ones for endpoints accepting an array of inputs
+        into batched requests. Threads with a cached response are finished as soon as the batch
+        runs (see AssistantBatchThread.cached_result), so the cache isn't read from this thread.
+        """
+        for batch in AssistantBatchThread.pack(threads):
+            if len(batch) == 1:
+                self.submit(batch[0], owner)
+                continue
+            for thread in batch:
+                thread.owner = owner
+                thread.queued = True
+            self.submit(AssistantBatchThread(batch), owner)
+
+    def finished(self, thread):
+        """
+        Called by the thread when it's done. Passes the result to the threads waiting for it,
+        and starts queued threads if any.
+        """
+        with self.lock:
+            self.running.discard(thread)
+            followers = []
+            if self.inflight.get(thread.fingerprint) is thread:
+                del(self.inflight[thread.fingerprint])
+                followers = self.followers.pop(thread.fingerprint, [])
+                if thread.cancelled.is_set() and followers:
+                    # other prompts still wait for this request, one of them will send it
+                    leader = followers.pop(0)
+                    leader.queued = True
+                    leader.running = False
+                    self.inflight[leader.fingerprint] = leader
+                    self.followers[leader.fingerprint] = followers
+                    self.queues[leader.priority].appendleft(leader)
+                    followers = []
+        for follower in followers:
+            result = thread.result
+            if isinstance(result, dict) and result.get('streamed'):
+                # the text was streamed to the view of the thread in flight, not to the followers'
+                result = dict(result)
+                result['streamed'] = False
+            follower.finish(result)
+        self.schedule()
+
+    def cancel(self, thread):
+        """
+        Cancels the thread. A queued or waiting thread is finished right away, while a running one
+        aborts its request and finishes as soon as its socket is shut down.
+        """
+        waiting = False
+        with self.lock:
+            running = thread in self.running
+            queue = self.queues.get(getattr(thread, 'priority', None), ())
+            if thread in queue:
+                queue.remove(thread)
+                waiting = True
+            elif thread in self.followers.get(thread.fingerprint, []):
+                self.followers[thread.fingerprint].remove(thread)
+                waiting = True
+        if waiting:
+            thread.cancelled.set()
+            thread.finish({'error': "Request cancelled."})
+        elif running:
+            thread.cancel()
+
+    def cancel_all(self, owner=None):
+        """
+        Cancels all the threads of the given owner, or all threads if not given.
+
+        Returns:
+            int: The number of cancelled threads.
+        """
+        with self.lock:
+            threads = list(self.running)
+            for queue in self.queues.values():
+                threads += queue
+            for followers in self.followers.values():
+                threads += followers
+        threads = [t for t in threads if owner is None or t.owner == owner]
+        for thread in threads:
+            self.cancel(thread)
+        return len(threads)
+
+    def has_capacity(self, priority, running, limit, reserved):
+        """
+        Returns True if a thread of the priority class can start, given the running threads per class,
+        their limit, and the requests reserved per class: if it's below its reserved requests, or there
+        are free requests not reserved by other classes. Reserved requests never take them all, so no
+        class starves.
+        """
+        total = sum(running.values())
+        if total >= limit:
+            return False
+        if running[priority] < reserved.get(priority, 0):
+            return True
+        held = sum(max(0, reserved.get(other, 0) - running[other]) for other in PRIORITIES if other != priority)
+        return total + min(held, limit - 1) < limit
+
+    def schedule(self):
+        """
+        Starts as many queued threads as allowed by the limits, from the highest priority class,
+        keeping the queue order for threads targeting the same server.
+        """
+        to_start = []
+        retry_in = None
+        now = time.perf_counter()
+        max_requests = max(1, self.settings.max_requests)
+        reserved = self.settings.reserved_requests
+        # of the connections of each server, one for each class with requests reserved
+        reserved_connections = dict((priority, min(1, count)) for priority, count in reserved.items())
+        with self.lock:
+            running = dict.fromkeys(PRIORITIES, 0)
+            servers = {}  # sid -> running threads per class
+            for thread in self.running:
+                running[thread.priority] += 1
+                server = servers.setdefault(thread.endpoint.sid, dict.fromkeys(PRIORITIES, 0))
+                server[thread.priority] += 1
+            limited = set()  # servers held back by their rate limit
+            for priority in PRIORITIES:
+                queue = self.queues[priority]
+                skipped = deque()
+                while queue and self.has_capacity(priority, running, max_requests, reserved):
+                    thread = queue.popleft()
+                    sid = thread.endpoint.sid
+                    server = servers.setdefault(sid, dict.fromkeys(PRIORITIES, 0))
+                    limit = max(1, thread.endpoint.max_connections)
+                    if sid in limited or not self.has_capacity(priority, server, limit, reserved_connections):
+                        skipped.append(thread)
+                        continue
+                    wait = limiter_for(thread.endpoint).reserve(thread.tokens)
+                    if wait > 0:
+                        retry_in = wait if retry_in is None else min(retry_in, wait)
+                        limited.add(sid)
+                        skipped.append(thread)
+                        continue
+                    thread.queued = False
+                    thread.running = True
+                    for follower in self.followers.get(thread.fingerprint, []):
+                        follower.queued = False
+                        follower.running = True
+                    self.running.add(thread)
+                    running[priority] += 1
+                    server[priority] += 1
+                    if thread.submitted is not None:
+                        self.waits[priority].add(now - thread.submitted)
+                    to_start.append(thread)
+                skipped.extend(queue)
+                self.queues[priority] = skipped
+            if retry_in is not None:
+                self.schedule_in(retry_in)
+        engine = self.engine if self.settings.engine == 'asyncio' else None
+        for thread in to_start:
+            if engine:
+                engine.submit(thread)
+            else:
+                thread.start()
+
+    def schedule_in(self, seconds):
+        """
+        Calls schedule after the given seconds, unless it's already going to be called before.
+        Must be called holding the lock.
+        """
+        at = time.time() + seconds
+        if self.timer and self.timer.is_alive() and self.timer_at <= at:
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(seconds, self.schedule)
+        self.timer.daemon = True
+        self.timer_at = at
+        self.timer.start()
+
+    def counts(self):
+        """
+        Returns the number of running and queued threads.
+        """
+        with self.lock:
+            return len(self.running), sum(len(queue) for queue in self.queues.values())
+
+    def status(self):
+        """
+        Returns, per priority class, the running and queued threads, the seconds the oldest queued one
+        is waiting, and the histogram of the seconds threads waited in the queue.
+        """
+        now = time.perf_counter()
+        status = {}
+        with self.lock:
+            for priority in PRIORITIES:
+                queue = self.queues[priority]
+                oldest = queue[0].submitted if queue and queue[0].submitted is not None else None
+                status[priority] = {
+                    'running': sum(1 for thread in self.running if thread.priority == priority),
+                    'queued': len(queue),
+                    'oldest': now - oldest if oldest is not None else None,
+                    'waits': self.waits[priority],
+                }
+        return status
+
+    def report(self):
+        """
+        Returns a text table with the status of each priority class.
+        """
+        lines = ["Queue", "  {:<16}{:>10}{:>10}{:>10}{:>10}{:>10}".format('class', 'running', 'queued', 'oldest',
+            'p50 wait', 'p99 wait')]
+        for priority, status in sorted(self.status().items(), key=lambda item: PRIORITIES.index(item[0])):
+            lines.append("  {:<16}{:>10}{:>10}{:>10}{:>10}{:>10}".format(priority, status['running'],
+                status['queued'], format_seconds(status['oldest']), format_seconds(status['waits'].percentile(50)),
+                format_seconds(status['waits'].percentile(99))))
+        return "\n".join(lines)
+
+class HedgedRequest(object):
+    """
+    Sends the same prompt to a primary endpoint and to alternate ones, keeping the first good result.
+
+    As per the prompt 'hedge' option, alternates are sent if the primary doesn't respond within
+    'delay' seconds, or right away in 'race' mode. Alternates are also sent if the primary fails.
+    Once a result wins, the other requests are cancelled.
+
+    It exposes what handle_thread needs from a thread: 'result', 'prompt', 'region', 'stack' and 'callbacks'.
+    """
+    def __init__(self, threads, spec):
+        self.threads = threads
+        self.primary = threads[0]
+        self.alternates = threads[1:]
+        self.delay = spec.get('delay', 2)
+        self.race = spec.get('race', False)
+        self.prompt = self.primary.prompt
+        self.region = self.primary.region
+        self.stack = self.primary.stack
+        self.stream = False
+        self.result = None
+        self.winner = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.dispatcher = None
+        self.owner = None
+        self.hedged = False
+        self.pending = set()
+        self.timer = None
+
+    def submit(self, dispatcher, owner=None):
+        """
+        Submits the primary thread, and the alternates in race mode or after the delay.
+        """
+        self.dispatcher = dispatcher
+        self.owner = owner
+        for thread in self.threads:
+            thread.callbacks.append(self.finished)
+        with self.lock:
+            self.pending.add(self.primary)
+        dispatcher.submit(self.primary, owner)
+        if self.race or self.delay <= 0:
+            self.hedge()
+            return
+        self.timer = threading.Timer(self.delay, self.hedge)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def hedge(self):
+        """
+        Submits the alternate threads, unless a result is already known or the primary is cancelled.
+        """
+        with self.lock:
+            if self.hedged or self.result is not None or self.primary.cancelled.is_set():
+                return
+            self.hedged = True
+            self.pending.update(self.alternates)
+        for thread in self.alternates:
+            self.dispatcher.submit(thread, self.owner)
+
+    def finished(self, thread):
+        """
+        Called by each thread when it's done. The first good result wins and the others are cancelled.
+        If all fail, the result is the primary one.
+        """
+        failover = False
+        with self.lock:
+            if self.result is not None:
+                return
+            self.pending.discard(thread)
+            result = thread.result
+            if isinstance(result, dict) and not result.get('error'):
+                self.winner = thread
+            elif self.pending:
+                return
+            elif not self.hedged and not thread.cancelled.is_set():
+                failover = True
+            else:
+                self.winner = self.primary
+            if not failover:
+                self.result = self.winner.result
+                losers = list(self.pending)
+                self.pending.clear()
+        if failover:
+            self.hedge()
+            return
+        if self.timer:
+            self.timer.cancel()
+        for loser in losers:
+            self.dispatcher.cancel(loser)
+        for callback in self.callbacks:
+            callback(self)
@@ -0,0 +1,418 @@
+import time
+import socket
+import asyncio
+import threading
+from urllib.parse import urlparse
+from .assistant_http import ssl_contexts, EventStreamParser, ContentDecoder
+from .assistant_ratelimit import limiter_for, backoff, parse_retry_after
+from .assistant_cassette import cassette
+from .assistant_thread import RequestCancelled
+
+# Errors raised when a reused keep-alive connection was closed by the server while idle.
+STALE_CONNECTION_ERRORS = (ConnectionError, asyncio.IncompleteReadError)
+
+class AsyncConnection(object):
+    """
+    A keep-alive HTTP/1.1 connection over asyncio streams.
+    """
+    def __init__(self, key, host, reader, writer):
+        self.key = key
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.released_at = 0
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, method, resource, body, headers):
+        lines = ['{} {} HTTP/1.1'.format(method, resource), 'Host: {}'.format(self.host)]
+        headers = dict(headers)
+        headers['Content-Length'] = str(len(body))
+        lines += ['{}: {}'.format(k, v) for k, v in headers.items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+    async def getresponse(self, method):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("The server closed the connection.")
+        version, _, rest = line.decode('latin-1').strip().partition(' ')
+        status, _, reason = rest.partition(' ')
+        headers = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionResetError("The server closed the connection.")
+            line = line.decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+        return AsyncResponse(self, version, int(status), reason, headers, method)
+
+class AsyncResponse(object):
+    """
+    The response to a request of an AsyncConnection, read as an http.client.HTTPResponse but with
+    a coroutine: 'await read(size)' returns b'' at the end of the body.
+    """
+    def __init__(self, conn, version, status, reason, headers, method):
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = 'chunked' in (self.getheader('Transfer-Encoding') or '').lower()
+        length = self.getheader('Content-Length')
+        self.length = int(length) if length and not self.chunked else None
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self.length = 0
+        connection = (self.getheader('Connection') or '').lower()
+        self.will_close = ('close' in connection or (version == 'HTTP/1.0' and 'keep-alive' not in connection)
+            or (self.length is None and not self.chunked))
+        self.chunk_left = 0  # bytes left of the current chunk (chunked bodies)
+        self.done = False
+
+    def getheader(self, name, default=None):
+        values = [v for k, v in self.headers if k.lower() == name.lower()]
+        return ', '.join(values) if values else default
+
+    def getheaders(self):
+        return list(self.headers)
+
+    async def read(self, size=65536):
+        if self.done:
+            return b''
+        reader = self.conn.reader
+        if self.chunked:
+            if not self.chunk_left:
+                line = await reader.readline()
+                self.chunk_left = int(line.split(b';')[0].strip() or b'0', 16)
+                if not self.chunk_left:
+                    # the trailers, up to a blank line
+                    while (await reader.readline()).strip():
+                        pass
+                    self.done = True
+                    return b''
+            data = await reader.read(min(size, self.chunk_left))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', self.chunk_left)
+            self.chunk_left -= len(data)
+            if not self.chunk_left:
+                await reader.readexactly(2)  # the CRLF closing the chunk
+            return data
+        if self.length is None:
+            data = await reader.read(size)
+            self.done = not data
+            return data
+        if not self.length:
+            self.done = True
+            return b''
+        data = await reader.read(min(size, self.length))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', self.length)
+        self.length -= len(data)
+        return data
+
+class AsyncEngine(object):
+    """
+    Sends the requests of all prompts from a single asyncio event loop, running in one background thread,
+    instead of a thread per request. Set the 'engine' general setting to 'asyncio' to use it.
+
+    Requests keep the semantics of AssistantThread (the thread is not started, but its methods prepare the
+    request, parse the response and finish it): retries, rate limits, cache, compression, streaming, stats
+    and cancellation. Connections are kept alive in a pool of the loop, per server.
+
+    Blocking work (decompressing and parsing whole responses, and the cache, which may read and write to disk)
+    runs in the default executor of the loop, so it doesn't hold up the other requests. Bodies are read whole
+    before parsing them. The events of streamed responses are decompressed and parsed on the loop as they
+    arrive, since they are small and a trip to the executor for each read costs more than parsing it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.idle = {}   # key -> list of idle AsyncConnection
+        self.tasks = set()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        Starts the event loop in a background thread, unless already running.
+        """
+        with self.lock:
+            if self.running:
+                return
+            ready = threading.Event()
+            self.loop = asyncio.new_event_loop()
+            def run(loop):
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+            self.thread = threading.Thread(target=run, args=(self.loop,), name='AssistantAI engine', daemon=True)
+            self.thread.start()
+            ready.wait()
+
+    def stop(self):
+        """
+        Cancels the running requests, closes the idle connections, and stops the event loop.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            loop = self.loop
+            future = asyncio.run_coroutine_threadsafe(self.shutdown(), loop)
+            try:
+                future.result(5)
+            except Exception as e:
+                print("AssistantAI: WARNING: the engine didn't stop cleanly: {}".format(e))
+            loop.call_soon_threadsafe(loop.stop)
+            self.thread.join(5)
+            loop.close()
+            self.loop = None
+            self.thread = None
+
+    async def shutdown(self):
+        tasks = [task for task in self.tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=2)
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle = {}
+
+    def submit(self, thread):
+        """
+        Sends the request of the thread from the event loop. Called instead of thread.start().
+        While recording or replaying a cassette, requests are run by their thread, as cassettes wrap
+        the blocking responses.
+        """
+        if cassette.mode:
+            thread.start()
+            return
+        self.start()
+        loop = self.loop
+        def done(task):
+            self.tasks.discard(task)
+            # cancelled before its first step, so run() didn't finish the thread
+            if task.cancelled():
+                thread.finish(thread.error_result(RequestCancelled("Request cancelled.")))
+        def create():
+            # cancelled before the task existed
+            if thread.cancelled.is_set():
+                thread.finish(thread.error_result(RequestCancelled("Request cancelled.")))
+                return
+            task = loop.create_task(self.run(thread))
+            self.tasks.add(task)
+            task.add_done_callback(done)
+            thread.aborter = lambda: loop.call_soon_threadsafe(task.cancel)
+        loop.call_soon_threadsafe(create)
+
+    async def run(self, thread):
+        """
+        As AssistantThread.run, but from the event loop.
+        """
+        # a single timer cancels the request at its deadline, instead of a timeout on each await
+        task = asyncio.current_task()
+        expired = []
+        def expire():
+            expired.append(True)
+            task.cancel()
+        timer = asyncio.get_event_loop().call_later(thread.timeout, expire)
+        try:
+            thread.running = True
+            thread.deadline = time.time() + thread.timeout
+            if thread.submitted is not None:
+                thread.metrics['queue'] = time.perf_counter() - thread.submitted
+            result = await self.call(thread.cached_result) if thread.cache_policy is not None else None
+            if result is None:
+                result = await self.get_response(thread)
+                thread.count_tokens(result)
+                if thread.cache_policy is not None:
+                    await self.call(thread.cache_result, result)
+        except (Exception, asyncio.CancelledError) as e:
+            if isinstance(e, asyncio.CancelledError):
+                e = socket.timeout() if expired else RequestCancelled("Request cancelled.")
+            result = thread.error_result(e)
+        finally:
+            timer.cancel()
+        thread.finish(result)
+
+    async def call(self, function, *args):
+        """
+        Returns the result of a blocking function, run in the default executor of the loop.
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def get_response(self, thread):
+        """
+        As AssistantThread.get_response: sends the request, retrying as per the server 'retries' settings.
+        """
+        spec = {
+            'max': 2,
+            'backoff': 1,
+            'max_backoff': 30,
+            'statuses': [429, 503],
+        }
+        spec.update(thread.endpoint.retries or {})
+        limiter = limiter_for(thread.endpoint)
+        attempt = 0
+        while True:
+            try:
+                response, body, result = await self.send(thread)
+            except ConnectionRefusedError:
+                if attempt >= spec['max'] or thread.cancelled.is_set():
+                    raise
+                delay = backoff(attempt, spec)
+            else:
+                limiter.update(response)
+                if response.status not in spec['statuses'] or attempt >= spec['max']:
+                    if result is not None:
+                        return result
+                    start = time.perf_counter()
+                    result = await self.call(thread.parse_body, response, body)
+                    thread.metrics['extract'] = time.perf_counter() - start
+                    return result
+                delay = parse_retry_after(response.getheader('Retry-After'))
+                if delay is None:
+                    delay = backoff(attempt, spec)
+            delay = max(delay, limiter.blocked_for())
+            if delay >= thread.check_deadline():
+                raise socket.timeout("Request ran out of time ({}s).".format(thread.timeout))
+            attempt += 1
+            print("AssistantAI: Retrying request to '{}/{}' in {:.1f}s (attempt {}).".format(
+                thread.endpoint.sid, thread.endpoint.eid, delay, attempt))
+            await asyncio.sleep(delay)
+
+    async def connect(self, thread):
+        """
+        Takes an idle connection to the server of the thread endpoint, or opens a new one.
+        """
+        endpoint = thread.endpoint
+        key = (endpoint.sid, endpoint.url)
+        idle = self.idle.get(key, [])
+        now = time.time()
+        while idle:
+            conn = idle.pop()
+            if now - conn.released_at < endpoint.keep_alive and not conn.reader.at_eof():
+                conn.reused = True
+                return conn
+            conn.close()
+        url = urlparse(endpoint.url)
+        scheme = str(url.scheme)
+        hostname = str(url.hostname)
+        port = url.port or (443 if scheme == 'https' else 80)
+        context = ssl_contexts.get(endpoint.credentials) if scheme == 'https' else None
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection(hostname, port, ssl=context,
+            server_hostname=hostname if context else None)
+        thread.metrics['connect'] = thread.metrics.get('connect', 0) + time.perf_counter() - start
+        host = hostname if url.port is None else '{}:{}'.format(hostname, port)
+        return AsyncConnection(key, host, reader, writer)
+
+    def release(self, conn):
+        conn.released_at = time.time()
+        self.idle.setdefault(conn.key, []).append(conn)
+
+    async def send(self, thread):
+        """
+        As AssistantThread.send: sends the request once.
+
+        Returns:
+            tuple: The response, and its JSON document, or the result if the response is streamed.
+        """
+        data, headers = thread.prepare_body()
+        method = thread.endpoint.method
+        resource = thread.resource
+        thread.metrics['request_bytes'] = len(data)
+        conn = await self.connect(thread)
+        try:
+            start = time.perf_counter()
+            try:
+                await conn.request(method, resource, data, headers)
+                response = await conn.getresponse(method)
+            except STALE_CONNECTION_ERRORS:
+                # a kept alive connection may be closed by the server while idle, retry once with a new one
+                if not conn.reused or thread.cancelled.is_set():
+                    raise
+                conn.close()
+                conn = await self.connect(thread)
+                start = time.perf_counter()
+                await conn.request(method, resource, data, headers)
+                response = await conn.getresponse(method)
+            thread.metrics['ttfb'] = time.perf_counter() - start
+            body = result = None
+            if response.getheader('Content-Type', '').startswith('text/event-stream'):
+                result = await self.read_events(thread, response)
+            else:
+                body = await self.read_document(thread, response)
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return response, body, result
+
+    async def read_document(self, thread, response):
+        """
+        As AssistantThread.read_document, but the body is read before decompressing and parsing it,
+        in the executor (parsing doesn't await).
+        """
+        decoder = ContentDecoder(response.getheader('Content-Encoding'))
+        start = time.perf_counter()
+        thread.metrics['download'] = 0
+        thread.metrics['response_bytes'] = 0
+        chunks = []
+        while True:
+            started = time.perf_counter()
+            chunk = await response.read(65536)
+            thread.metrics['download'] += time.perf_counter() - started
+            thread.metrics['response_bytes'] += len(chunk)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        chunks.reverse()
+        def read():
+            while chunks:
+                chunk = decoder.decompress(chunks.pop())
+                if chunk:
+                    return chunk
+            return decoder.flush()
+        try:
+            return await self.call(thread.parse_document, read)
+        except ValueError:
+            if response.status >= 400:
+                return None
+            raise
+        finally:
+            thread.metrics['parse'] = time.perf_counter() - start - thread.metrics['download']
+
+    async def read_events(self, thread, response):
+        """
+        As AssistantThread.read_events: reads the server-sent events, passing their text to on_chunk.
+        """
+        parser = EventStreamParser()
+        decoder = ContentDecoder(response.getheader('Content-Encoding'))
+        state = thread.events_state()
+        start = time.perf_counter()
+        thread.metrics['download'] = 0
+        thread.metrics['response_bytes'] = 0
+        while True:
+            started = time.perf_counter()
+            chunk = await response.read(65536)
+            thread.metrics['download'] += time.perf_counter() - started
+            thread.metrics['response_bytes'] += len(chunk)
+            events = parser.feed(decoder.decompress(chunk)) if chunk else parser.feed(decoder.flush()) + parser.close()
+            for data in events:
+                thread.handle_event(data, state)
+            if not chunk:
+                break
+        thread.metrics['parse'] = time.perf_counter() - start - thread.metrics['download']
+        return await self.call(thread.events_result, state)
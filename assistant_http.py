@@ -0,0 +1,298 @@
+import os
+import ssl
+import zlib
+import codecs
+import time
+import threading
+import http.client
+
+class ConnectionPool(object):
+    """
+    A pool of keep-alive HTTP(S) connections, shared by all the AssistantAI threads.
+
+    Connections are grouped by server (its id and URL), so consecutive prompts, chained prompts
+    and concurrent threads targeting the same server reuse the already established sockets
+    instead of paying a new TCP and TLS handshake on each request.
+    """
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.idle = {}    # key -> list of (connection, released_at)
+        self.in_use = {}  # key -> number of checked out connections
+
+    @staticmethod
+    def key_for(endpoint):
+        """
+        Returns the key identifying the pool of connections for the server of the given endpoint.
+        """
+        return (endpoint.sid, endpoint.url)
+
+    def acquire(self, endpoint, factory, timeout=None):
+        """
+        Get a connection for the server of the given endpoint.
+
+        An idle connection is reused if available. Otherwise, a new one is created using the
+        factory, unless the server already has 'max_connections' open sockets. In that case,
+        waits for any of them to be released.
+
+        Args:
+            endpoint (Endpoint): The endpoint that will be requested.
+            factory (callable): Creates a new, not yet connected, HTTP(S) connection.
+            timeout (float): Max seconds to wait for a free connection. None waits forever.
+
+        Returns:
+            http.client.HTTPConnection: The connection. Its 'assistant_reused' attribute is True
+            if the connection was already used by a previous request.
+
+        Raises:
+            TimeoutError: If no connection is released in time.
+        """
+        key = self.key_for(endpoint)
+        limit = max(1, endpoint.max_connections or 1)
+        keep_alive = endpoint.keep_alive
+        deadline = time.time() + timeout if timeout else None
+        with self.lock:
+            while True:
+                self._evict(key, keep_alive)
+                idle = self.idle.get(key)
+                if idle:
+                    conn, _ = idle.pop()
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    conn.assistant_reused = True
+                    return conn
+                if self.in_use.get(key, 0) < limit:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No connection available for '{}' after {}s.".format(endpoint.sid, timeout))
+                self.lock.wait(remaining)
+        try:
+            conn = factory()
+        except Exception:
+            self._forget(key)
+            raise
+        conn.assistant_key = key
+        conn.assistant_reused = False
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool of idle connections, to be reused later.
+        The response must be completely read before releasing its connection.
+        """
+        key = getattr(conn, 'assistant_key', None)
+        if key is None:
+            conn.close()
+            return
+        with self.lock:
+            self.in_use[key] = max(0, self.in_use.get(key, 0) - 1)
+            self.idle.setdefault(key, []).append((conn, time.time()))
+            self.lock.notify()
+
+    def discard(self, conn):
+        """
+        Closes a connection that must not be reused (i.e.: failed, or the server asked to close it).
+        """
+        conn.close()
+        key = getattr(conn, 'assistant_key', None)
+        if key is not None:
+            self._forget(key)
+
+    def close_all(self):
+        """
+        Closes all idle connections. Called when the plugin is unloaded.
+        """
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle = {}
+            self.lock.notify_all()
+
+    def _forget(self, key):
+        with self.lock:
+            self.in_use[key] = max(0, self.in_use.get(key, 0) - 1)
+            self.lock.notify()
+
+    def _evict(self, key, keep_alive):
+        """
+        Closes the idle connections of the given key that were unused for more than keep_alive seconds.
+        Must be called holding the lock.
+        """
+        idle = self.idle.get(key)
+        if not idle:
+            return
+        now = time.time()
+        keep = []
+        for conn, released_at in idle:
+            if now - released_at > keep_alive:
+                conn.close()
+            else:
+                keep.append((conn, released_at))
+        self.idle[key] = keep
+
+class SSLContextCache(object):
+    """
+    SSL contexts shared by all connections, one per distinct set of server credentials.
+
+    Loading CA bundles and certificate chains from disk is expensive, so each context is built once
+    and only rebuilt when the credentials point to other files, or the files are modified.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contexts = {}  # (verify, cert) -> (files mtimes, context)
+
+    @staticmethod
+    def key_for(credentials):
+        """
+        Returns the (verify, cert) tuple, with expanded paths, given the server credentials.
+        """
+        verify = cert = None
+        if isinstance(credentials, dict):
+            verify = credentials.get('verify')
+            cert = credentials.get('cert')
+        verify = str(os.path.expanduser(verify)) if verify else None
+        # a client certificate is only used along with a CA bundle to verify the server
+        cert = str(os.path.expanduser(cert)) if verify and cert else None
+        return (verify, cert)
+
+    @staticmethod
+    def mtimes_for(key):
+        mtimes = []
+        for path in key:
+            try:
+                mtimes.append(os.path.getmtime(path) if path else None)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def get(self, credentials):
+        """
+        Returns the SSL context for the given server credentials, building it if needed.
+        """
+        key = self.key_for(credentials)
+        mtimes = self.mtimes_for(key)
+        with self.lock:
+            cached = self.contexts.get(key)
+            if cached and cached[0] == mtimes:
+                return cached[1]
+        context = self.build(key)
+        with self.lock:
+            self.contexts[key] = (mtimes, context)
+        return context
+
+    def prepare(self, endpoints):
+        """
+        Builds the SSL contexts needed by the given endpoints, and drops the ones no longer used.
+        Called when settings are loaded.
+        """
+        keys = set()
+        for endpoint in endpoints:
+            if not endpoint.url or not endpoint.url.startswith('https'):
+                continue
+            keys.add(self.key_for(endpoint.credentials))
+            try:
+                self.get(endpoint.credentials)
+            except (OSError, ssl.SSLError) as e:
+                # will fail again, and be reported, when requesting the endpoint
+                print("AssistantAI: WARNING: can't load SSL credentials for server '{}': {}".format(endpoint.sid, e))
+        with self.lock:
+            for key in list(self.contexts):
+                if key not in keys:
+                    del(self.contexts[key])
+
+    @staticmethod
+    def build(key):
+        verify, cert = key
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        if verify:
+            context.load_verify_locations(cafile=verify)
+            if cert:
+                context.load_cert_chain(cert)
+        return context
+
+class EventStreamParser(object):
+    """
+    Incremental parser of server-sent events (text/event-stream responses).
+
+    Feed it with bytes as they are received, and get the data of each completed event.
+    """
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.buffer = ''
+        self.data = []
+
+    def feed(self, chunk):
+        """
+        Parses a chunk of the response body.
+
+        Returns:
+            list: The data (str) of all the events completed by this chunk.
+        """
+        events = []
+        text = self.buffer + self.decoder.decode(chunk)
+        self.buffer = ''
+        # a trailing '\r' may be followed by '\n' in the next chunk
+        if text.endswith('\r'):
+            text, self.buffer = text[:-1], '\r'
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        # the last line is incomplete, keep it for the next chunk
+        self.buffer = lines.pop() + self.buffer
+        for line in lines:
+            if not line:
+                # a blank line dispatches the event
+                if self.data:
+                    events.append('\n'.join(self.data))
+                    self.data = []
+                continue
+            if line.startswith(':'):
+                continue  # comment
+            field, _, value = line.partition(':')
+            if field == 'data':
+                self.data.append(value[1:] if value.startswith(' ') else value)
+        return events
+
+    def close(self):
+        """
+        Returns the data of the last event if the stream ended without a blank line.
+        """
+        if self.buffer or self.data:
+            return self.feed(b'\n\n')
+        return []
+
+class ContentDecoder(object):
+    """
+    Incremental decompressor of a response body, as per its Content-Encoding (gzip or deflate).
+
+    Feed it with the bytes as they are received, and get the decompressed bytes.
+    """
+    def __init__(self, encoding):
+        self.encoding = (encoding or 'identity').strip().lower()
+        self.zobj = None
+        self.flushed = False
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding not in ('deflate', 'identity'):
+            raise ValueError("Unsupported response Content-Encoding '{}'.".format(encoding))
+
+    def decompress(self, chunk):
+        if self.encoding == 'identity' or not chunk:
+            return chunk
+        if self.zobj is None:
+            # 'deflate' should be zlib wrapped, but some servers send it raw
+            wbits = zlib.MAX_WBITS if chunk[0] & 0x0f == 8 else -zlib.MAX_WBITS
+            self.zobj = zlib.decompressobj(wbits)
+        return self.zobj.decompress(chunk)
+
+    def flush(self):
+        if self.zobj is None or self.flushed:
+            return b''
+        self.flushed = True
+        return self.zobj.flush()
+
+# Errors raised when a reused keep-alive socket was closed by the server while idle.
+STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, http.client.CannotSendRequest, ConnectionError)
+
+# The global pool and SSL contexts used by all threads.
+pool = ConnectionPool()
+ssl_contexts = SSLContextCache()
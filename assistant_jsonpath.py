@@ -0,0 +1,259 @@
+import re
+import json
+import codecs
+from .assistant_qdict import compile_path, plain_key, KEY, ANY_WITH
+
+# A selector that materializes the whole value
+FULL = True
+# A value not complete in the buffer
+MISSING = object()
+
+def compile_selector(paths, sep='/'):
+    """
+    Compiles the paths of an endpoint response into a selector: a tree of dicts from keys
+    (or '*' for any key) to their child selectors, with FULL for the values to materialize.
+
+    Keys with a filter expression, or '**', select their whole value, since filters may refer to
+    any of its keys. Indexes such as '-1' or '01' select the whole array, since the parser only knows
+    items by their position.
+
+    Returns:
+        dict: The selector, or None if any path selects the whole document (i.e.: '.').
+    """
+    root = {}
+    for path in paths:
+        if not isinstance(path, str) or not path:
+            continue
+        if path == '.':
+            return None
+        node = root
+        parent = parent_key = None
+        steps = compile_path(path, sep)
+        for index, (key, expr, kind, _) in enumerate(steps):
+            if kind == KEY and not plain_key(key):
+                if parent is None:
+                    return None
+                parent[parent_key] = FULL
+                break
+            if expr or kind == ANY_WITH or index + 1 == len(steps):
+                # '**' matches any key, as '*'
+                node['*' if kind == ANY_WITH else key] = FULL
+                break
+            child = node.get(key)
+            if child is FULL:
+                break
+            if child is None:
+                child = node[key] = {}
+            parent, parent_key = node, key
+            node = child
+    return root
+
+def merge_selectors(a, b):
+    if a is None or a is b:
+        return b
+    if b is None:
+        return a
+    if a is FULL or b is FULL:
+        return FULL
+    merged = dict(a)
+    for key, child in b.items():
+        merged[key] = merge_selectors(merged.get(key), child)
+    return merged
+
+def child_selector(selector, key):
+    """
+    Returns the selector for the value at the given key (or index), or None if it's not selected.
+    """
+    if selector is FULL:
+        return FULL
+    return merge_selectors(selector.get(key), selector.get('*'))
+
+class PrunedJSONParser(object):
+    """
+    Incremental JSON parser that only materializes the values selected by a selector (see compile_selector).
+
+    The body is read in chunks with read(), which returns b'' at the end. Values not selected are
+    skipped without decoding them, and their text is dropped as soon as it's scanned. The result is
+    a pruned document, where paths of the selector resolve as in the whole document: objects only
+    have the selected keys, and arrays keep their length with None in place of items not selected.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    STRING = re.compile(r'(?:[^"\\]|\\.)*', re.S)
+    SCALAR = re.compile(r'[^,\]} \t\n\r]*')
+
+    def __init__(self, selector, read):
+        self.selector = selector
+        self.read = read
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.mark = None  # start of the value being materialized, kept in the buffer
+        self.eof = False
+
+    def parse(self):
+        """
+        Returns the pruned document.
+
+        Raises:
+            ValueError: If the body is not valid JSON.
+        """
+        document = self.value(self.selector)
+        if self.peek():
+            raise ValueError("Extra data after the JSON document.")
+        return document
+
+    def fill(self):
+        """
+        Reads the next chunk into the buffer, dropping the already parsed text.
+        Returns False at the end of the body.
+        """
+        if self.eof:
+            return False
+        start = self.pos if self.mark is None else self.mark
+        if start:
+            self.buf = self.buf[start:]
+            self.pos -= start
+            if self.mark is not None:
+                self.mark = 0
+        chunk = self.read()
+        if not chunk:
+            self.eof = True
+            self.buf += self.decoder.decode(b'', final=True)
+            return False
+        self.buf += self.decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace, and returns the next char, or '' at the end of the body.
+        """
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expecting one of '{}' at char {} of the JSON chunk.".format(chars, self.pos))
+        self.pos += 1
+        return c
+
+    def value(self, selector):
+        c = self.peek()
+        if selector is None:
+            self.skip_value()
+            return None
+        if selector is FULL or c not in '{[':
+            return self.materialize()
+        if c == '{':
+            return self.parse_object(selector)
+        return self.parse_array(selector)
+
+    def materialize(self):
+        if self.peek() in ('{', '[', '"'):
+            value = self.decode_buffered()
+            if value is not MISSING:
+                return value
+        # the value continues in the next chunks, scan up to its end keeping it in the buffer
+        self.mark = self.pos
+        try:
+            self.skip_value(decode=False)
+            value, end = self.json.raw_decode(self.buf, self.mark)
+        finally:
+            self.mark = None
+        if end != self.pos:
+            raise ValueError("Invalid JSON value at char {} of the JSON chunk.".format(end))
+        return value
+
+    def decode_buffered(self):
+        """
+        Decodes the value at the current position, if it's complete in the buffer. Much faster
+        than scanning it, since it's done by the C decoder.
+
+        Returns:
+            The value, or MISSING if it's not complete (or not valid).
+        """
+        try:
+            value, self.pos = self.json.raw_decode(self.buf, self.pos)
+        except ValueError:
+            return MISSING
+        return value
+
+    def parse_object(self, selector):
+        self.pos += 1
+        document = {}
+        if self.peek() == '}':
+            self.pos += 1
+            return document
+        while True:
+            if self.peek() != '"':
+                raise ValueError("Expecting a key at char {} of the JSON chunk.".format(self.pos))
+            key = self.materialize()
+            self.expect(':')
+            child = child_selector(selector, key)
+            if child is None:
+                self.skip_value()
+            else:
+                document[key] = self.value(child)
+            if self.expect(',}') == '}':
+                return document
+
+    def parse_array(self, selector):
+        self.pos += 1
+        document = []
+        if self.peek() == ']':
+            self.pos += 1
+            return document
+        while True:
+            document.append(self.value(child_selector(selector, str(len(document)))))
+            if self.expect(',]') == ']':
+                return document
+
+    def skip_value(self, decode=True):
+        c = self.peek()
+        if c == '"':
+            self.skip_string()
+        elif c in ('{', '['):
+            # small values are decoded and dropped, big ones are scanned
+            if not decode or self.decode_buffered() is MISSING:
+                self.skip_structure()
+        elif c:
+            self.skip_scalar()
+        else:
+            raise ValueError("Unexpected end of the JSON document.")
+
+    def skip_string(self):
+        self.pos += 1
+        while True:
+            self.pos = self.STRING.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) and self.buf[self.pos] == '"':
+                self.pos += 1
+                return
+            if not self.fill():
+                raise ValueError("Unterminated string in the JSON document.")
+
+    def skip_scalar(self):
+        while True:
+            self.pos = self.SCALAR.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def skip_structure(self):
+        close = '}' if self.buf[self.pos] == '{' else ']'
+        self.pos += 1
+        if self.peek() == close:
+            self.pos += 1
+            return
+        while True:
+            if close == '}':
+                if self.peek() != '"':
+                    raise ValueError("Expecting a key at char {} of the JSON chunk.".format(self.pos))
+                self.skip_string()
+                self.expect(':')
+            self.skip_value()
+            if self.expect(',' + close) == close:
+                return
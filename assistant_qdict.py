@@ -1,123 +1,424 @@
+import threading
+from itertools import islice
+from collections import OrderedDict
 
-class QDict():
+# Kinds of compiled path steps
+KEY = 'key'       # a key of a dict, or an index of a list
+ANY = '*'         # any key or index
+ANY_WITH = '**'   # any key or index whose value matches the rest of the path, selecting the value itself
+
+class CompiledCache(object):
+    """
+    A process-wide LRU of compiled values (i.e.: paths or filter expressions), bounded in number of items.
+    Values are compiled on a miss by calling compiler with the key.
+    """
+    def __init__(self, compiler, size):
+        self.lock = threading.Lock()
+        self.compiler = compiler
+        self.items = OrderedDict()
+        self.size = size
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                return value
+        value = self.compiler(key)
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+class Predicate(object):
+    """
+    A filter expression, compiled once. It's evaluated without builtins, in a scope with only the names
+    it uses: '_path', '_key' and '_item', or keys of the item (with '.' replaced by '_').
+    Any other name raises NameError.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.code = compile(expr, "<string>", "eval")
+        self.names = self.code.co_names
+        self.uses_path = '_path' in self.names
+
+    def __call__(self, path, key, item):
+        scope = {}
+        for name in self.names:
+            if name == '_path':
+                scope[name] = path
+            elif name == '_key':
+                scope[name] = key
+            elif name == '_item':
+                scope[name] = item
+            elif isinstance(item, dict) and name in item:
+                scope[name] = item[name]
+            else:
+                # keys with dots are named with underscores
+                keys = [k for k in item if k.replace('.', '_') == name] if isinstance(item, dict) and '_' in name else []
+                if not keys:
+                    raise NameError("Use of '{}' not allowed in filer expressions, and the key is not found on this item. Evaluating '{}'".format(name, self.expr))
+                scope[name] = item[keys[-1]]
+        return eval(self.code, {"__builtins__": {}}, scope)
+
+def parse_path(path, sep='/'):
+    """
+    Parses a path into its steps: a tuple of (key, expr, kind, text), where expr is the filter
+    expression of the step (if any), kind is KEY, ANY or ANY_WITH, and text is the path from the step.
+    """
+    steps = []
+    rem = path
+    while rem:
+        text = rem
+        key, expr, rem = QDict._getKeyExprRem(rem, sep)
+        kind = key if key in (ANY, ANY_WITH) else KEY
+        steps.append((key, expr, kind, text))
+    return tuple(steps)
+
+def plain_key(key):
+    """
+    Returns False for keys written as indexes other than the index itself (i.e.: '-1' or '01'),
+    which match list items by their int value.
+    """
+    try:
+        index = int(key)
+    except ValueError:
+        return True
+    return index >= 0 and str(index) == key
+
+def compile_path(path, sep='/'):
+    """
+    Returns the steps of a path (see parse_path), parsed once per process.
+    """
+    return paths.get((path, sep))
+
+class PathTrie(object):
+    """
+    The paths of several targets, compiled into a trie of their steps, to extract all of them from
+    a document in one traversal (see QDict.extract). Targets in many get all their matches, as
+    QDict.values, and the others their first match, as QDict.get.
+    """
+    def __init__(self, paths, many=(), sep='/'):
+        self.root = PathTrieNode(None)
+        self.many = frozenset(many)
+        self.names = []
+        self.fallback = {}  # name -> path, for paths with '**' before the last step, matched on their own
+        for name, path in paths:
+            self.names.append(name)
+            steps = compile_path(path, sep) if isinstance(path, str) else ()
+            if any(kind == ANY_WITH for _, _, kind, _ in steps[:-1]):
+                self.fallback[name] = (path, sep)
+                continue
+            node = self.root
+            for step in steps:
+                # filters using '_path' get the text of the path from the step, that paths may not share
+                key = step if step[1] else step[:3]
+                child = node.children.get(key)
+                if child is None:
+                    child = node.children[key] = PathTrieNode(step)
+                node = child
+            if steps:
+                node.targets.append(name)
+        self.root.index(self.many)
+
+class PathTrieNode(object):
+    def __init__(self, step):
+        self.step = step
+        self.children = OrderedDict()
+        self.targets = []
+        self.firsts = frozenset()  # targets below, wanting their first match
+        self.alls = False          # if any target below wants all its matches
+
+    def index(self, many):
+        firsts = set(name for name in self.targets if name not in many)
+        self.alls = any(name in many for name in self.targets)
+        for child in self.children.values():
+            child.index(many)
+            firsts |= child.firsts
+            self.alls = self.alls or child.alls
+        self.firsts = frozenset(firsts)
+
+def compile_predicate(expr):
+    """
+    Returns the Predicate of a filter expression, compiled once per process.
+    """
+    return predicates.get(expr)
+
+def compile_trie(paths, many=(), sep='/'):
+    """
+    Returns the PathTrie of the paths (a dict of target names to paths), compiled once per process.
+    """
+    return tries.get((tuple(sorted(paths.items())), tuple(sorted(many)), sep))
+
+class PathIndex(object):
+    """
+    A document flattened into a table of all its values by path (a tuple of keys, with list indexes
+    as strings), and posting lists of the values with each key at each depth, in document order.
+    """
     def __init__(self, data):
-        self.data = data
-        self.codecache = {}
+        self.entries = []   # (keys, value), in document order
+        self.table = {}     # keys -> value
+        self.postings = {}  # (depth, key) -> positions in entries, and (depth, None) for any key
+        self.add((), data)
 
-    def find(self, path, data=None, sep='/'):
+    def add(self, parents, data):
         if not data:
-            data = self.data
-        return self._get(path, data=data, sep=sep)
+            return
+        if isinstance(data, dict):
+            children = ((k if isinstance(k, str) else str(k), item) for k, item in data.items())
+        elif isinstance(data, (list, tuple)):
+            children = ((str(i), item) for i, item in enumerate(data))
+        else:
+            return
+        depth = len(parents)
+        entries, table, postings = self.entries, self.table, self.postings
+        anykey = postings.setdefault((depth, None), [])
+        for name, item in children:
+            keys = parents + (name,)
+            position = len(entries)
+            entries.append((keys, item))
+            table[keys] = item
+            posting = postings.get((depth, name))
+            if posting is None:
+                posting = postings[(depth, name)] = []
+            posting.append(position)
+            anykey.append(position)
+            if item and isinstance(item, (dict, list, tuple)):
+                self.add(keys, item)
+
+    def match(self, steps):
+        """
+        Yields the (keys, value) matching the steps, which can only have keys and '*' without filters.
+        """
+        keys = [(depth, key) for depth, (key, _, kind, _) in enumerate(steps) if kind == KEY]
+        if len(keys) == len(steps):
+            path = tuple(key for _, key in keys)
+            if path in self.table:
+                yield path, self.table[path]
+            return
+        depth = len(steps) - 1
+        last = steps[-1]
+        if last[2] == KEY:
+            keys.pop()
+        entries = self.entries
+        for position in self.postings.get((depth, last[0] if last[2] == KEY else None), ()):
+            path, item = entries[position]
+            for i, key in keys:
+                if path[i] != key:
+                    break
+            else:
+                yield path, item
+
+class QDict():
+    """
+    Queries a document by paths (i.e.: 'choices/0/text', 'data/*[state == 'open']/id').
+
+    With index, the document is flattened into a PathIndex on the first query, and queries of plain keys
+    and '*' are answered from it, which is cheaper when querying the same big document many times.
+    """
+    def __init__(self, data, index=False):
+        self.data = data
+        self.indexed = index
+        self.path_index = None
+
+    def iter(self, path, data=None, sep='/', limit=None):
+        """
+        Yields the (path, value) of each match of the path, lazily, up to limit matches.
+        """
+        for found, _, item in self._iter(path, data, sep, limit):
+            yield found, item
+
+    def find(self, path, data=None, sep='/', limit=None):
+        return dict(self.iter(path, data=data, sep=sep, limit=limit))
 
-    def paths(self, path, data=None, sep='/'):
-        items = self.find(path, data=data, sep=sep)
-        return list(items)
+    def paths(self, path, data=None, sep='/', limit=None):
+        return [found for found, _, _ in self._iter(path, data, sep, limit)]
 
     def get(self, path, data=None, sep='/'):
-        items = self.find(path, data=data, sep=sep)
-        return items.get(path)
+        """
+        Returns the value at the path (the first match, for paths with wildcards or filters), or None.
+        """
+        return self.first(path, data=data, sep=sep)
 
-    def keys(self, path, data=None, sep='/'):
-        paths = self.paths(path, data=data, sep=sep)
-        keys = list()
-        for path in paths:
-            keys.append(QDict._getDeepestKey(path, sep))
-        return keys
+    def first(self, path, data=None, sep='/', default=None):
+        for _, _, item in self._iter(path, data, sep, 1):
+            return item
+        return default
+
+    def exists(self, path, data=None, sep='/'):
+        for _ in self._iter(path, data, sep, 1):
+            return True
+        return False
+
+    def keys(self, path, data=None, sep='/', limit=None):
+        return [key for _, key, _ in self._iter(path, data, sep, limit)]
 
     def uniqKeys(self, path, data=None, sep='/'):
         return set(self.keys(path, data=data, sep=sep))
 
-    def values(self, path, data=None, sep='/'):
-        items = self.find(path, data=data, sep=sep)
-        return list(items.values())
+    def values(self, path, data=None, sep='/', limit=None):
+        return [item for _, _, item in self._iter(path, data, sep, limit)]
 
     def uniqValues(self, path, data=None, sep='/'):
         return set(self.values(path, data=data, sep=sep))
 
-    def items(self, path, data=None, sep='/'):
-        results = self.find(path, data=data, sep=sep)
-        items = list()
-        for path, item in results.items():
-            items.append((QDict._getDeepestKey(path, sep), item))
-        return items
+    def items(self, path, data=None, sep='/', limit=None):
+        return [(key, item) for _, key, item in self._iter(path, data, sep, limit)]
 
     def uniqItems(self, path, data=None, sep='/'):
         return set(self.items(path, data=data, sep=sep))
 
-    def _get(self, path, data, parents=None, sep='/'):
+    def _iter(self, path, data, sep, limit=None):
+        """
+        Yields the (path, deepest key, value) of each match of the path, up to limit matches.
+        """
+        steps = compile_path(path, sep)
+        if not steps or limit is not None and limit < 1:
+            return
+        if not data and self.indexed and QDict._indexable(steps):
+            matches = self._match_index(steps, sep)
+        else:
+            matches = self._match(steps, 0, data or self.data, None, sep)
+        if limit is not None:
+            matches = islice(matches, limit)
+        for match in matches:
+            yield match
+
+    def index(self):
+        """
+        Returns the PathIndex of the document, built on first use.
+        """
+        if self.path_index is None:
+            self.path_index = PathIndex(self.data)
+        return self.path_index
+
+    def _match_index(self, steps, sep):
+        for keys, item in self.index().match(steps):
+            path = sep.join(keys)
+            if path.count(sep) >= len(keys):
+                # keys with the separator are quoted
+                path = sep.join("'{}'".format(key) if key.find(sep) > 0 else key for key in keys)
+            yield path, keys[-1], item
+
+    @staticmethod
+    def _indexable(steps):
+        """
+        Returns True if the steps can be matched with the index: only keys and '*', without filters,
+        and indexes as the index keeps them (i.e.: not '-1' or '01').
+        """
+        for key, expr, kind, _ in steps:
+            if expr or kind == ANY_WITH:
+                return False
+            if kind == KEY and not plain_key(key):
+                return False
+        return True
+
+    def extract(self, trie, data=None):
+        """
+        Returns the values of all targets of a PathTrie (see compile_trie) in one traversal,
+        as a dict of target names to values: a list of all matches for targets in trie.many,
+        and the first match (or None) for the others.
+        """
         if not data:
-            return dict()
-        if not path:
-            return data
-        key, expr, rem = QDict._getKeyExprRem(path, sep)
-        res = dict()
-        if key == '*' or key == '**':
-            if isinstance(data, dict):
-                for item in data:
-                    p = "'{}'[{}]".format(item, expr) if expr else "'{}'".format(item)
-                    res.update(self._get(p, data=data, parents=parents, sep=sep))
-            elif isinstance(data, (list, set, tuple)):
-                for index, item in enumerate(data):
-                    p = "'{}'[{}]".format(index, expr) if expr else "'{}'".format(index)
-                    res.update(self._get(p, data=data, parents=parents, sep=sep))
-        elif hasattr(data, '__iter__'):
-            if key in data:
-                pathkey = "'{}'".format(key) if key.find(sep) > 0 else key
-                thispath = parents + sep + pathkey if parents else pathkey
-                item = data[key]
-                if self._evalItem(path, expr, key, item):
-                    res[thispath] = item
+            data = self.data
+        results = dict((name, [] if name in trie.many else None) for name in trie.names)
+        self._extract(trie.root, data, trie.many, results, set())
+        for name, (path, sep) in trie.fallback.items():
+            results[name] = self.values(path, data, sep) if name in trie.many else self.get(path, data, sep)
+        return results
+
+    def _extract(self, node, data, many, results, found):
+        for child in node.children.values():
+            if not child.alls and child.firsts <= found:
+                continue
+            for _, _, item in self._step(child.step, data):
+                for name in child.targets:
+                    if name in many:
+                        results[name].append(item)
+                    elif name not in found:
+                        results[name] = item
+                        found.add(name)
+                if child.children:
+                    self._extract(child, item, many, results, found)
+                if not child.alls and child.firsts <= found:
+                    break
+
+    def _match(self, steps, index, data, parents, sep):
+        """
+        Yields the matches of the steps from index in data, which is at the parents path.
+        """
+        last = index + 1 == len(steps)
+        kind = steps[index][2]
+        for name, k, item in self._step(steps[index], data):
+            pathkey = "'{}'".format(name) if isinstance(k, str) and name.find(sep) > 0 else name
+            thispath = parents + sep + pathkey if parents else pathkey
+            if last:
+                yield thispath, name, item
+            elif kind == ANY_WITH:
+                # the value itself, if anything below matches the rest of the path
+                for _ in self._match(steps, index + 1, item, thispath, sep):
+                    yield thispath, name, item
+                    break
             else:
-                try:
-                    if int(key) in data or data[int(key)]:
-                        thispath = parents + sep + key if parents else key
-                        item = data[int(key)]
-                        if self._evalItem(path, expr, int(key), item):
-                            res[thispath] = item
-                except ValueError:
-                    pass
-        if not rem:
-            return res
-        else:
-            subres = dict()
-            for path, item in res.items():
-                childs = self._get(rem, data=item, parents=path, sep=sep)
-                if key == '**' and childs:
-                    subres.update({path: item})
-                else:
-                    subres.update(childs)
-            return subres
-
-    def _evalExpr(self, expr, scope, cache=True):
-        if cache and expr in self.codecache:
-            code = self.codecache[expr]
+                for match in self._match(steps, index + 1, item, thispath, sep):
+                    yield match
+
+    def _step(self, step, data):
+        """
+        Yields the (name, key, value) of the children of data matching a step, and its filter if any.
+        """
+        if not data:
+            return
+        key, expr, kind, text = step
+        if kind == KEY:
+            children = self._child(key, data)
+        elif isinstance(data, dict):
+            children = ((k if isinstance(k, str) else str(k), k, item) for k, item in data.items())
+        elif isinstance(data, (list, tuple)):
+            children = ((str(i), i, item) for i, item in enumerate(data))
         else:
-            code = compile(expr, "<string>", "eval")
-            self.codecache[expr] = code
-        for name in code.co_names:
-            if name not in scope:
-                raise NameError("Use of '{}' not allowed in filer expressions, and the key is not found on this item. Evaluating '{}'".format(name, expr))
-        return eval(code, {"__builtins__": {}}, scope)
-
-    def _evalItem(self, path, expr, key, item):
+            children = ()
         if not expr:
-            return True
-        scope = {
-            "_path": path,
-            "_key": key,
-            "_item": item,
-        }
-        if isinstance(item, dict):
-            for k in item.keys():
-                if k in scope:
-                    continue
-                scope[k.replace('.', '_')] = item[k]
+            for child in children:
+                yield child
+            return
+        predicate = compile_predicate(expr)
+        for name, k, item in children:
+            scope_path = None
+            if predicate.uses_path:
+                scope_path = text if kind == KEY else "'{}'[{}]".format(name, expr)
+            if self._evalItem(predicate, scope_path, k, item):
+                yield name, k, item
+
+    @staticmethod
+    def _child(key, data):
+        """
+        Returns the child at the key (or index) as a list of one (name, key, value), or an empty one.
+        """
+        if isinstance(data, dict):
+            if key in data:
+                return [(key, key, data[key])]
+            try:
+                index = int(key)
+            except ValueError:
+                return []
+            return [(key, index, data[index])] if index in data else []
+        if isinstance(data, (list, tuple)):
+            try:
+                index = int(key)
+            except ValueError:
+                return []
+            return [(key, index, data[index])] if -len(data) <= index < len(data) else []
+        return []
+
+    def _evalItem(self, predicate, path, key, item):
         try:
-            return self._evalExpr(expr, scope)
+            return predicate(path, key, item)
         except NameError as ne:
-            print("Error while evaluating expression for '{}': {}. {}".format(key, expr, ne))
+            print("Error while evaluating expression for '{}': {}. {}".format(key, predicate.expr, ne))
         except KeyError as ke:
-            print("Error while evaluating expression for '{}': {}. {}".format(key, expr, ke))
+            print("Error while evaluating expression for '{}': {}. {}".format(key, predicate.expr, ke))
         return False
 
     @staticmethod
@@ -160,10 +461,7 @@ class QDict():
             rem = path[i+1:]
         return (key, expr, rem)
 
-    @staticmethod
-    def _getDeepestKey(path, sep):
-        key = rem = path
-        while rem != '':
-            key, _, rem = QDict._getKeyExprRem(rem, sep)
-        return key
-
+# The compiled paths and filter expressions of all QDicts
+paths = CompiledCache(lambda key: parse_path(*key), 1024)
+predicates = CompiledCache(Predicate, 256)
+tries = CompiledCache(lambda key: PathTrie(*key), 256)
@@ -0,0 +1,156 @@
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+class TokenBucket(object):
+    """
+    A token bucket: holds up to 'capacity' tokens, refilled at 'rate' tokens per second.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount, now):
+        """
+        Returns the seconds until the given amount of tokens is available (0 if it's available now).
+        Amounts bigger than the bucket capacity wait for a full bucket.
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter(object):
+    """
+    Limits the requests sent to a server, as per its 'rate_limit' settings:
+    'requests_per_second' and 'tokens_per_minute'.
+
+    It also holds back all requests when the server tells so, with 'Retry-After'
+    or 'x-ratelimit-*' response headers.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.lock = threading.Lock()
+        self.blocked_until = 0
+        self.requests = None
+        self.tokens = None
+        rps = spec.get('requests_per_second')
+        if rps:
+            self.requests = TokenBucket(rps, max(1, rps))
+        tpm = spec.get('tokens_per_minute')
+        if tpm:
+            self.tokens = TokenBucket(tpm / 60.0, tpm)
+
+    def reserve(self, tokens=0):
+        """
+        Takes one request, and the estimated tokens, if available now.
+
+        Returns:
+            float: 0 if reserved, or the seconds to wait before trying again.
+        """
+        now = time.time()
+        with self.lock:
+            wait = max(0, self.blocked_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.wait_for(1, now))
+            if self.tokens:
+                wait = max(wait, self.tokens.wait_for(tokens, now))
+            if wait > 0:
+                return wait
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            return 0
+
+    def blocked_for(self):
+        """
+        Returns the seconds the server asked to wait before sending more requests.
+        """
+        with self.lock:
+            return max(0, self.blocked_until - time.time())
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def update(self, response):
+        """
+        Holds back requests as per the rate limit headers of the response, if any.
+        """
+        retry_after = parse_retry_after(response.getheader('Retry-After'))
+        if retry_after and response.status in (429, 503):
+            self.block(retry_after)
+        for kind in ('requests', 'tokens'):
+            remaining = response.getheader('x-ratelimit-remaining-' + kind)
+            reset = parse_duration(response.getheader('x-ratelimit-reset-' + kind))
+            if remaining is not None and reset and remaining.strip() == '0':
+                self.block(reset)
+
+def parse_retry_after(value):
+    """
+    Returns the seconds of a Retry-After header, given as seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def parse_duration(value):
+    """
+    Returns the seconds of a duration like '1s', '6m0s', '20ms' or '0.5' (as in x-ratelimit-reset-* headers).
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    for number, unit in parts:
+        seconds += float(number) * units[unit]
+    return seconds
+
+def backoff(attempt, spec):
+    """
+    Returns the seconds to wait before the given retry attempt (starting at 0), with exponential
+    backoff from 'backoff' seconds up to 'max_backoff', and a random jitter.
+    """
+    delay = min(spec.get('max_backoff', 30), spec.get('backoff', 1) * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def limiter_for(endpoint):
+    """
+    Returns the rate limiter of the endpoint server. Recreated if its settings change.
+    """
+    with limiters_lock:
+        limiter = limiters.get(endpoint.sid)
+        if not limiter or limiter.spec != endpoint.rate_limit:
+            limiter = RateLimiter(endpoint.rate_limit or {})
+            limiters[endpoint.sid] = limiter
+        return limiter
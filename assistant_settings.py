@@ -1,7 +1,13 @@
+import os
 import sublime
 import copy
 import uuid
-from .assistant_qdict import QDict
+from .assistant_qdict import QDict, compile_trie
+from .assistant_jsonpath import compile_selector
+from .assistant_template import Template, compile_template, expand
+from .assistant_http import ssl_contexts
+from .assistant_cache import cache
+from .assistant_cassette import cassette
 
 PKG_NAME = 'AssistantAI'
 SETTINGS_FILE = 'assistant_ai.sublime-settings'
@@ -80,6 +86,32 @@ class SettingsDataLoader(object):
                 raise TypeError("'{}' must be an object or string. id='{}'.".format(key, self.ident))
         return item
 
+    def load_dict_or_bool(self, data, key):
+        """
+        Load an option that can be enabled with true, or with an object of settings.
+
+        Returns:
+            None if not given, False if disabled, or a dict (maybe empty) if enabled.
+
+        Raises:
+            TypeError: If item is not a boolean nor an object.
+        """
+        if not data:
+            return None
+        try:
+            item = copy.deepcopy(data.get(key))
+        except TypeError:
+            return None
+        if item is None:
+            return None
+        if item is True:
+            return {}
+        if item is False:
+            return False
+        if isinstance(item, dict):
+            return item
+        raise TypeError("'{}' must be a boolean or an object. id='{}'.".format(key, self.ident))
+
     def load_list_str(self, data, key, str_to_list=True):
         if not data:
             return []
@@ -223,6 +255,64 @@ class SettingsDataLoader(object):
         cls = type(self)
         return cls(new_spec, self.ident).import_completed()
 
+def replace_path(data, path, value):
+    """
+    Returns a copy of data with the value at the given path (keys separated by '/') replaced.
+    Only the objects along the path are copied.
+    """
+    key, _, rem = path.partition('/')
+    data = dict(data)
+    data[key] = replace_path(data[key], rem, value) if rem else value
+    return data
+
+def merge_event(document, event):
+    """
+    Returns the document with the JSON document of an event of a streamed response merged into it:
+    objects are merged by key, arrays by index, and other values are replaced. Modifies the document.
+    """
+    if isinstance(document, dict) and isinstance(event, dict):
+        for key, value in event.items():
+            document[key] = merge_event(document.get(key), value)
+        return document
+    if isinstance(document, list) and isinstance(event, list):
+        for index, value in enumerate(event):
+            if index < len(document):
+                document[index] = merge_event(document[index], value)
+            else:
+                document.append(value)
+        return document
+    return event
+
+def set_path(data, path, value):
+    """
+    Sets the value at the given path (keys separated by '/') of data, adding the missing objects.
+
+    Returns:
+        bool: False if the path goes through a value that is not an object or array.
+    """
+    keys = path.split('/')
+    for key in keys[:-1]:
+        if isinstance(data, list) and key.isdigit():
+            while len(data) <= int(key):
+                data.append({})
+            data = data[int(key)]
+        elif isinstance(data, dict):
+            if not isinstance(data.get(key), (dict, list)):
+                data[key] = {}
+            data = data[key]
+        else:
+            return False
+    key = keys[-1]
+    if isinstance(data, list) and key.isdigit():
+        while len(data) <= int(key):
+            data.append(None)
+        data[int(key)] = value
+    elif isinstance(data, dict):
+        data[key] = value
+    else:
+        return False
+    return True
+
 class Endpoint(SettingsDataLoader):
     def __init__(self, data, ident=None, item_type='endpoint'):
         """
@@ -241,8 +331,15 @@ class Endpoint(SettingsDataLoader):
         self.required_vars = self.load_list_str(data, 'required_vars')
         # request body and params specification
         self.valid_params = self.load_dict(data, 'valid_params')
+        # params that only apply to streamed requests, dropped from the others
+        self.stream_params = self.load_list_str(data, 'stream_params')
         self.request = self.load_dict(data, 'request')
         self.query = self.load_dict(data, 'query')
+        # batching: a request param accepting an array of inputs, and the response items per input
+        self.batch = self.load_dict(data, 'batch')
+        # tokens the model accepts (prompt and completion), and the local tokenizer to estimate them
+        self.context_window = self.load_int(data, 'context_window', 0)
+        self.tokenizer = self.load_str(data, 'tokenizer', 'approx')
         # response data retrieval specification
         self.response = self.load_dict(data, 'response')
         if 'paths' not in self.response:  # backwards compatibility to simple response definition
@@ -257,18 +354,37 @@ class Endpoint(SettingsDataLoader):
         self.response['paths'].setdefault('text', 'data')
         self.response['paths'].setdefault('error', 'error')
         self.response.setdefault('output', "${text}")
+        # the values to parse from responses, as per the response paths
+        self.selector = compile_selector(self.response['paths'].values())
+        # templates, compiled once
+        self.request_templates = dict((k, compile_template(v)) for k, v in self.request.items())
+        self.query_templates = dict((k, compile_template(v)) for k, v in self.query.items())
+        self.resource_template = Template(self.resource)
+        self.output_template = compile_template(self.response['output'])
+        # the output is the text as it is, so streamed text can be written as it's received
+        self.output_is_text = self.response['output'] == "${text}"
+        list_item = self.response.get('templates', {}).get('list_item')
+        self.list_item_template = compile_template(list_item) if list_item else None
+        # response caching (opt-in)
+        self.cache = self.load_dict_or_bool(data, 'cache')
         # server data
         self.sid = None
         self.server_name = None
         self.url = None
         self.timeout = None
+        self.max_connections = None
+        self.keep_alive = None
+        self.retries = None
+        self.rate_limit = None
+        self.compression = None
         self.credentials = None
         self.required_credentials = None
         self.headers = None
 
     def set_server_data(self, server):
         """
-        Set the server data (ID, server name, URL, timeout, credentials, required credentials, and headers)
+        Set the server data (ID, server name, URL, timeout, connection pool limits, retries and rate limits,
+        compression, credentials, required credentials, and headers)
         Args:
             server (Server): The server object containing the desired data to be set.
         Returns:
@@ -279,6 +395,11 @@ class Endpoint(SettingsDataLoader):
         self.server_name = server.name
         self.url = server.url
         self.timeout = server.timeout
+        self.max_connections = server.max_connections
+        self.keep_alive = server.keep_alive
+        self.retries = server.retries
+        self.rate_limit = server.rate_limit
+        self.compression = server.compression
         self.credentials = server.credentials
         self.required_credentials = server.required_credentials
         self.headers = server.headers
@@ -288,48 +409,86 @@ class Endpoint(SettingsDataLoader):
         # get the response remplate of the endpoint
         spec = self.response
         paths = spec.get('paths', {})
-        output = spec.get('output', '${text}')
         if not spec or not paths or not isinstance(paths, dict):
             response['error'] = "The endpoint doesn't specify any valid reponse template."
             return response
-        # get the data from specified paths
-        qdata = QDict(data)
+        # get the data from specified paths, all in one traversal (all matches of paths with wildcards)
+        targets = dict((key, path) for key, path in paths.items() if isinstance(path, str) and path != '.')
+        many = [key for key, path in targets.items() if '*' in path]
+        extracted = QDict(data).extract(compile_trie(targets, many))
         for key, path in paths.items():
-            if '*' in path:
-                response[key] = qdata.values(path)
-            elif path == '.':
-                response[key] = data
-            else:
-                response[key] = qdata.get(path)
+            response[key] = data if path == '.' else extracted.get(key)
         # collect all vars from the object retreived with path 'vars'
         if 'vars' in response and isinstance(response['vars'], dict):
             for k, v in response['vars'].items():
                 if not isinstance(v, (list, dict)):
                     k = '_' + str(k) if k in response else str(k)
                     response[k] = str(v)
-        # expand output, with keys in response and collected vars
-        str_response = self.ensure_dict_str_str(response)
-        response['output'] = sublime.expand_variables(output, str_response)
+        # expand output, with keys in response and collected vars (only string values are expanded)
+        response['output'] = self.output_template.render(response)
         # prepare the returned list (used for inputs of type 'list_from_prompt')
         if 'list' in response and isinstance(response['list'], list):
             new_list = []
-            templates = spec.get('templates', {})
-            list_item_template = templates.get('list_item')
+            list_item_template = self.list_item_template
             if list_item_template:
                 for item in response['list']:
                     if isinstance(item, dict):
-                        str_item = self.ensure_dict_str_str(item)
-                        new_item = sublime.expand_variables(list_item_template, str_item)
-                        new_list.append(new_item)
+                        new_list.append(list_item_template.render(item))
                     else:
                         new_list.append([str(item)])
             else:
                 new_list = [[str(item)] for item in response['list']]
             response['list'] = new_list
-        # include raw response
-        response['response'] = data
+        # include raw response (only the values selected by paths), unless disabled
+        if spec.get('raw', True):
+            response['response'] = data
         return response
 
+    def parse_batch_response(self, data, count):
+        """
+        Parses the response of a batched request, returning one parsed response per input.
+
+        Each input gets the whole response but with only its own items in the array at the batch 'items'
+        path, so the endpoint paths (i.e.: 'choices/0/text') apply as if the input was sent alone.
+        Items are matched to inputs by the batch 'index' key of each item, if given, or by position.
+        """
+        spec = self.batch
+        path = spec.get('items', '')
+        items = QDict(data).get(path) if isinstance(data, dict) and path else None
+        if not isinstance(items, list):
+            error = self.parse_response(data).get('error') or "The batched response doesn't include the items."
+            return [{'error': error} for _ in range(count)]
+        per_input = [[] for _ in range(count)]
+        index_key = spec.get('index')
+        for position, item in enumerate(items):
+            index = item.get(index_key) if index_key and isinstance(item, dict) else position
+            if isinstance(index, int) and 0 <= index < count:
+                per_input[index].append(item)
+        responses = []
+        for input_items in per_input:
+            if not input_items:
+                responses.append({'error': "The batched response doesn't include this input."})
+                continue
+            try:
+                responses.append(self.parse_response(replace_path(data, path, input_items)))
+            except (KeyError, TypeError):
+                responses.append({'error': "The batched response doesn't include the items."})
+        return responses
+
+    def parse_event(self, data):
+        """
+        Parses one event of a streamed response (i.e.: when the request sets 'stream').
+
+        The text is retrieved from the 'delta' path, or the 'text' path if the endpoint
+        doesn't specify it, and errors from the 'error' path.
+        """
+        paths = self.response.get('paths', {})
+        qdata = QDict(data)
+        return {
+            'text': qdata.get(paths.get('delta', paths.get('text'))),
+            'error': qdata.get(paths.get('error')),
+        }
+
     def to_dict(self):
         """
         Converts the Endpoint object into a dictionary format for JSON serialization.
@@ -342,13 +501,23 @@ class Endpoint(SettingsDataLoader):
             "resource": self.resource,
             "required_vars": self.required_vars,
             "valid_params": self.valid_params,
+            "stream_params": self.stream_params,
             "request": self.request,
             "query": self.query,
+            "batch": self.batch,
+            "context_window": self.context_window,
+            "tokenizer": self.tokenizer,
             "response": self.response,
+            "cache": self.cache,
             "sid": self.sid,
             "server_name": self.server_name,
             "url": self.url,
             "timeout": self.timeout,
+            "max_connections": self.max_connections,
+            "keep_alive": self.keep_alive,
+            "retries": self.retries,
+            "rate_limit": self.rate_limit,
+            "compression": self.compression,
             "credentials": self.credentials,
             "required_credentials": self.required_credentials,
             "headers": self.headers
@@ -366,6 +535,14 @@ class Server(SettingsDataLoader):
         self.name = self.load_str(data, 'name', self.sid.replace('_', ' ').title())
         self.url = self.load_str(data, 'url')
         self.timeout = self.load_int(data, 'timeout')
+        # Connection pool: max open sockets (thus concurrent requests), and seconds an idle socket is kept alive
+        self.max_connections = self.load_int(data, 'max_connections', 8)
+        self.keep_alive = self.load_int(data, 'keep_alive', 30)
+        # Retries of failed requests, and limits of requests and tokens sent
+        self.retries = self.load_dict(data, 'retries')
+        self.rate_limit = self.load_dict(data, 'rate_limit')
+        # Compression of requests and responses
+        self.compression = self.load_dict(data, 'compression')
         # Server requirements
         self.credentials = {}
         self.required_credentials = self.load_list_str(data, 'required_credentials')
@@ -384,7 +561,7 @@ class Server(SettingsDataLoader):
         self.headers = self.load_dict(self.spec, 'headers')
         safe_creds = self.ensure_dict_str_str(self.credentials)
         for k, v in self.headers.items():
-            self.headers[k] = str(sublime.expand_variables(v, safe_creds))
+            self.headers[k] = str(expand(v, safe_creds))
         for eid in self.endpoints:
             self.endpoints[eid].set_server_data(self)
 
@@ -397,6 +574,11 @@ class Server(SettingsDataLoader):
             "name": self.name,
             "url": self.url,
             "timeout": self.timeout,
+            "max_connections": self.max_connections,
+            "keep_alive": self.keep_alive,
+            "retries": self.retries,
+            "rate_limit": self.rate_limit,
+            "compression": self.compression,
             "credentials": self.credentials,
             "required_credentials": self.required_credentials,
             "headers": self.headers,
@@ -466,6 +648,10 @@ class Prompt(SettingsDataLoader):
         self.required_syntax = self.load_list_str(data, 'required_syntax')
         self.required_context = self.load_dict(data, 'required_context')
         self.required_endpoints = self.load_list_str(data, 'required_endpoints')
+        # Vars to trim, in order, when the request exceeds the endpoint context window
+        self.trim = self.load_list_str(data, 'trim')
+        if not self.trim:
+            self.trim = ['file_toc', 'file_symbols', 'pre', 'post']
         # Variables
         self.variables = self.load_dict(data, 'vars')
         if not self.variables:
@@ -476,8 +662,19 @@ class Prompt(SettingsDataLoader):
         # Payload params and query
         self.params = self.load_dict(data, 'params')
         self.query = self.load_dict(data, 'query')
+        # templates, compiled once. For convenience, in vars, each line may be a string of an array
+        self.variable_templates = dict((k, compile_template('\n'.join(v) if isinstance(v, list) else v))
+            for k, v in self.variables.items())
+        self.params_templates = dict((k, compile_template(v)) for k, v in self.params.items())
+        self.query_templates = dict((k, compile_template(v)) for k, v in self.query.items())
         # Command to execute
         self.command = self.load_dict(data, 'command', str_to_dict='cmd')
+        # Response caching, overrides the endpoint one
+        self.cache = self.load_dict_or_bool(data, 'cache')
+        # Hedging: the request is also sent to alternate endpoints, and the fastest wins
+        self.hedge = self.load_dict_or_bool(data, 'hedge')
+        # Class of its requests in the dispatcher queue, by default 'interactive' or 'chained'
+        self.priority = self.load_str(data, 'priority')
 
     def get_sublime_command(self):
         cmdmap = {
@@ -508,10 +705,13 @@ class Prompt(SettingsDataLoader):
             "required_syntax": self.required_syntax,
             "required_context": self.required_context,
             "required_endpoints": self.required_endpoints,
+            "trim": self.trim,
             "variables": self.variables,
             "params": self.params,
             "query": self.query,
-            "command": self.command
+            "command": self.command,
+            "cache": self.cache,
+            "hedge": self.hedge
         }
 
 class AssistantAISettings(SettingsDataLoader):
@@ -523,6 +723,11 @@ class AssistantAISettings(SettingsDataLoader):
         self.prompts = {}
         self.endpoints = {}
         self.settings_callbacks = {}
+        self.max_requests = 16
+        self.reserved_requests = {'interactive': 4, 'chained': 2, 'background': 0}
+        self.engine = 'threads'
+        self.cache = {}
+        self.cassette = {}
 
     def load(self):
         """
@@ -534,6 +739,19 @@ class AssistantAISettings(SettingsDataLoader):
 
         :return: None
         """
+        # General options
+        settings = self.load_settings_from(SETTINGS_FILE)
+        self.max_requests = self.load_int(settings, 'max_requests', 16)
+        # requests of max_requests only the given priority class can take (see Dispatcher)
+        self.reserved_requests = {'interactive': 4, 'chained': 2, 'background': 0}
+        for priority, reserved in self.load_dict(settings, 'reserved_requests').items():
+            if isinstance(reserved, int) and reserved >= 0:
+                self.reserved_requests[priority] = reserved
+        self.engine = self.load_str(settings, 'engine', 'threads')
+        self.cache = self.load_dict(settings, 'cache')
+        cache.configure(self.cache, os.path.join(sublime.cache_path(), PKG_NAME, 'responses'))
+        self.cassette = self.load_dict(settings, 'cassette')
+        cassette.configure(self.cassette, os.path.join(sublime.cache_path(), PKG_NAME, 'cassette.jsonl.gz'))
         # Get all settings from all packages that provides AssistantAI settings.
         files = set()
         for resource in sublime.find_resources(PKG_SETTINGS_FILE_BLOB):
@@ -545,6 +763,8 @@ class AssistantAISettings(SettingsDataLoader):
             servers = self.load_servers_from(settings, credentials)
             eps = self.load_endpoints_from(servers)
             self.endpoints.update(eps)
+        # build SSL contexts once, instead of reading CA bundles and certs on each request
+        ssl_contexts.prepare(self.endpoints.values())
         # load prompts now that we have all end points loaded.
         for file in files:
             settings = self.load_settings_from(file)
@@ -779,3 +999,14 @@ class AssistantAISettings(SettingsDataLoader):
                     to_filter.add(eid)
                     break
         return {k: v for k, v in self.endpoints.items() if k not in to_filter}
+
+    def get_alternate_endpoints(self, prompt, endpoint):
+        """
+        Returns the usable endpoints for a hedged prompt, other than the given one.
+        Only endpoints explicitly required by the prompt are alternates, up to its hedge 'alternates' count.
+        """
+        if not prompt.hedge or not prompt.required_endpoints:
+            return []
+        count = prompt.hedge.get('alternates', 1)
+        endpoints = self.get_endpoints_for_prompt(prompt)
+        return [ep for eid, ep in endpoints.items() if ep is not endpoint][:count]
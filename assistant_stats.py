@@ -0,0 +1,187 @@
+import json
+import math
+import time
+import threading
+from collections import deque
+
+# The phases of a request, in order, as shown by the stats command (seconds).
+PHASES = [
+    'prepare',    # expanding vars and templates, and fitting the context window
+    'queue',      # waiting in the dispatcher for a free slot or the rate limit
+    'connect',    # TCP connect and TLS handshake (only for new connections)
+    'ttfb',       # sending the request up to the response headers (time to first byte)
+    'download',   # reading the body from the socket
+    'parse',      # decompressing and parsing the JSON or the events, while reading the body
+    'extract',    # getting values with the response paths, and expanding the output templates
+    'apply',      # the edit command applying the result to the view
+    'total',      # from the prompt command to the applied result
+]
+# The payload sizes of a request (bytes).
+SIZES = ['request_bytes', 'response_bytes']
+
+class Histogram(object):
+    """
+    A histogram of positive values, with logarithmic buckets (each 5% wider than the previous one).
+    It's bounded in memory whatever the number of values, and percentiles have a 5% error at most.
+    """
+    GROWTH = 1.05
+    MIN = 1e-6
+
+    def __init__(self):
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = max(value, 0.0)
+        index = int(math.log(max(value, self.MIN) / self.MIN, self.GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Returns the value at the given percentile (0-100), or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # the middle of the bucket, within the seen values
+                value = self.MIN * self.GROWTH ** (index + 0.5)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+class Stats(object):
+    """
+    Timings per phase, and payload sizes, of the requests per endpoint and prompt.
+
+    Each metric is kept in a Histogram, and the last requests are kept as records (to be exported).
+    Failed requests are only counted, since their timings would skew the others.
+    """
+    def __init__(self, size=1000):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (endpoint, prompt, metric) -> Histogram
+        self.errors = {}      # endpoint -> failed requests
+        self.records = deque(maxlen=size)
+
+    def record(self, endpoint, prompt, metrics, error=None):
+        """
+        Adds the metrics (dict of metric -> value) of a request to endpoint (as 'sid/eid') by prompt (its id).
+        """
+        with self.lock:
+            record = {'time': time.time(), 'endpoint': endpoint, 'prompt': prompt}
+            record.update(metrics)
+            if error:
+                record['error'] = str(error)
+                self.records.append(record)
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                return
+            self.records.append(record)
+            for metric, value in metrics.items():
+                if value is None:
+                    continue
+                key = (endpoint, prompt, metric)
+                histogram = self.histograms.get(key)
+                if not histogram:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.add(value)
+
+    def summary(self, by='endpoint'):
+        """
+        Returns the histograms merged per endpoint (or per prompt), as {name: {metric: Histogram}}.
+        """
+        summary = {}
+        with self.lock:
+            for (endpoint, prompt, metric), histogram in self.histograms.items():
+                name = endpoint if by == 'endpoint' else prompt
+                merged = summary.setdefault(name, {}).setdefault(metric, Histogram())
+                merged.merge(histogram)
+        return summary
+
+    def report(self):
+        """
+        Returns a text table with the percentiles of each phase and size, per endpoint.
+        """
+        lines = []
+        summary = self.summary()
+        with self.lock:
+            errors = dict(self.errors)
+        for endpoint in sorted(set(summary) | set(errors)):
+            metrics = summary.get(endpoint, {})
+            total = metrics.get('total') or metrics.get('ttfb')
+            lines.append("{} ({} requests, {} failed)".format(endpoint, total.count if total else 0,
+                errors.get(endpoint, 0)))
+            lines.append("  {:<16}{:>10}{:>10}{:>10}{:>10}".format('phase', 'p50', 'p95', 'p99', 'count'))
+            for metric in PHASES + SIZES:
+                histogram = metrics.get(metric)
+                if not histogram:
+                    continue
+                fmt = format_bytes if metric in SIZES else format_seconds
+                lines.append("  {:<16}{:>10}{:>10}{:>10}{:>10}".format(metric,
+                    fmt(histogram.percentile(50)), fmt(histogram.percentile(95)),
+                    fmt(histogram.percentile(99)), histogram.count))
+            lines.append("")
+        return "\n".join(lines) if lines else "No requests yet."
+
+    def export(self, path):
+        """
+        Writes the last requests to the given file, as JSON lines. Returns the number of records.
+        """
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return len(records)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.errors.clear()
+            self.records.clear()
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    if value < 1:
+        return "{:.1f}ms".format(value * 1000)
+    return "{:.2f}s".format(value)
+
+def format_bytes(value):
+    if value is None:
+        return '-'
+    if value < 1024:
+        return "{:.0f}B".format(value)
+    return "{:.1f}KB".format(value / 1024.0)
+
+# The global stats of all threads.
+stats = Stats()
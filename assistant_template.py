@@ -0,0 +1,210 @@
+import re
+
+NAME = re.compile(r'[A-Za-z0-9_]+')
+
+class Template(object):
+    """
+    A string template, compiled once, with the syntax of sublime.expand_variables:
+    '$var', '${var}', '${var:default}' (the default may use variables too), and
+    '${var/regex/format/flags}'. '\\$' is a literal '$'.
+
+    Rendering doesn't need the Sublime API. Variables not given, empty, or not strings
+    expand to '' (or to the default, if any).
+    """
+    def __init__(self, source):
+        self.source = source
+        self.variables = set()
+        self.parts = self.parse(source)
+        if all(isinstance(part, str) for part in self.parts):
+            self.parts = [''.join(self.parts)]
+
+    def parse(self, source):
+        """
+        Returns the template parts: literal strings, and (name, default, regex) tuples for variables.
+        """
+        parts = []
+        literal = []
+        i = 0
+        size = len(source)
+        while i < size:
+            c = source[i]
+            if c == '\\' and source.startswith('$', i + 1):
+                literal.append('$')
+                i += 2
+                continue
+            if c != '$':
+                j = source.find('$', i)
+                k = source.find('\\', i)
+                end = min(x for x in (j, k, size) if x > i)
+                literal.append(source[i:end])
+                i = end
+                continue
+            part, end = self.parse_variable(source, i)
+            if part is None:
+                literal.append('$')
+                i += 1
+                continue
+            if literal:
+                parts.append(''.join(literal))
+                literal = []
+            parts.append(part)
+            self.variables.add(part[0])
+            i = end
+        if literal:
+            parts.append(''.join(literal))
+        return parts
+
+    def parse_variable(self, source, start):
+        """
+        Parses the variable starting with '$' at start.
+
+        Returns:
+            tuple: The (name, default, regex) part, or None if it's not a variable, and its end.
+        """
+        if not source.startswith('{', start + 1):
+            m = NAME.match(source, start + 1)
+            if not m:
+                return None, start
+            return (m.group(), None, None), m.end()
+        # find the closing brace, skipping nested ones (i.e.: in defaults)
+        depth = 0
+        end = start + 1
+        while end < len(source):
+            c = source[end]
+            if c == '\\':
+                end += 2
+                continue
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        else:
+            return None, start
+        inner = source[start + 2:end]
+        m = NAME.match(inner)
+        if not m:
+            return None, start
+        name = m.group()
+        rest = inner[m.end():]
+        if not rest:
+            return (name, None, None), end + 1
+        if rest[0] == ':':
+            default = Template(rest[1:])
+            self.variables.update(default.variables)
+            return (name, default, None), end + 1
+        if rest[0] == '/':
+            regex = self.parse_regex(rest[1:])
+            if regex:
+                return (name, None, regex), end + 1
+        return None, start
+
+    def parse_regex(self, spec):
+        """
+        Parses the 'regex/format/flags' of a variable substitution.
+
+        Returns:
+            tuple: The compiled regex, the format (as a Python replacement), and the count to replace.
+        """
+        fields = re.split(r'(?<!\\)/', spec)
+        if len(fields) != 3:
+            return None
+        pattern, fmt, flags = fields
+        try:
+            regex = re.compile(pattern.replace('\\/', '/'), re.I if 'i' in flags else 0)
+        except re.error:
+            return None
+        fmt = re.sub(r'\$(\d+)|\$\{(\d+)\}', lambda m: '\\g<{}>'.format(m.group(1) or m.group(2)), fmt.replace('\\/', '/'))
+        return regex, fmt, 0 if 'g' in flags else 1
+
+    def render(self, variables):
+        """
+        Returns the template expanded with the given variables.
+        """
+        parts = self.parts
+        if len(parts) == 1 and isinstance(parts[0], str):
+            return parts[0]
+        out = []
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            name, default, regex = part
+            value = variables.get(name)
+            if not value or not isinstance(value, str):
+                value = default.render(variables) if default else ''
+            elif regex:
+                try:
+                    value = regex[0].sub(regex[1], value, count=regex[2])
+                except (re.error, IndexError):
+                    pass
+            out.append(value)
+        return ''.join(out)
+
+class ListTemplate(object):
+    """
+    A list of templates, rendered into a list.
+    """
+    def __init__(self, items):
+        self.items = [compile_template(item) for item in items]
+        self.variables = set()
+        for item in self.items:
+            self.variables.update(item.variables)
+
+    def render(self, variables):
+        return [item.render(variables) for item in self.items]
+
+class DictTemplate(object):
+    """
+    A dict of templates, rendered into a dict with the same keys.
+    """
+    def __init__(self, items):
+        self.items = dict((k, compile_template(v)) for k, v in items.items())
+        self.variables = set()
+        for item in self.items.values():
+            self.variables.update(item.variables)
+
+    def render(self, variables):
+        return dict((k, v.render(variables)) for k, v in self.items.items())
+
+class Constant(object):
+    """
+    A value with nothing to expand (i.e.: a number or a boolean).
+    """
+    def __init__(self, value):
+        self.value = value
+        self.variables = set()
+
+    def render(self, variables):
+        return self.value
+
+def compile_template(value):
+    """
+    Compiles a value of the settings (a string, or lists and dicts of strings) into a template,
+    as sublime.expand_variables would expand it.
+    """
+    if isinstance(value, str):
+        return Template(value)
+    if isinstance(value, list):
+        return ListTemplate(value)
+    if isinstance(value, dict):
+        return DictTemplate(value)
+    return Constant(value)
+
+cache = {}
+
+def expand(value, variables):
+    """
+    Expands the value with the variables, as sublime.expand_variables. Compiled string templates
+    are kept, so expanding the same string again is a fast substitution.
+    """
+    if not isinstance(value, str):
+        return compile_template(value).render(variables)
+    template = cache.get(value)
+    if template is None:
+        if len(cache) >= 1024:
+            cache.clear()
+        template = cache[value] = Template(value)
+    return template.render(variables)
@@ -1,35 +1,86 @@
-import os
 import json
+import gzip
+import time
+import socket
 import threading
-import sublime
-import ssl
 import http.client
 from urllib.parse import urlparse, urlencode
-from .assistant_settings import AssistantAISettings, Endpoint, Prompt
+from .assistant_settings import AssistantAISettings, Endpoint, Prompt, merge_event, set_path
+from .assistant_http import pool, ssl_contexts, EventStreamParser, ContentDecoder, STALE_CONNECTION_ERRORS
+from .assistant_cache import cache, fingerprint
+from .assistant_ratelimit import limiter_for, backoff, parse_retry_after
+from .assistant_jsonpath import PrunedJSONParser
+from .assistant_tokens import counter_for, trim_text
+from .assistant_cassette import cassette, request_key
+
+class RequestCancelled(Exception):
+    pass
 
 class AssistantThread(threading.Thread):
     """
     An async thread class for accessing the remote server API, and waiting for a response
     """
     def __init__(self, settings, prompt, endpoint, region, text, pre, post, stack, kwargs):
-        super().__init__()
-        self.timeout = endpoint.timeout if endpoint.timeout else 60
-        self.running = False
-        self.result = None
-        self.settings = settings
-        self.prompt = prompt
-        self.endpoint = endpoint
-        self.region = region
-        self.stack = stack
+        self.setup(settings, prompt, endpoint, region, stack)
         # prompt vars may add text
         self.variables = self.prepare_vars(text, pre, post, kwargs)
         self.data = self.prepare_data()
+        # estimated tokens, trimming the context if it doesn't fit the endpoint context window
+        self.fit_context(text, pre, post, kwargs)
         self.query = self.prepare_query()
-        self.conn = self.prepare_conn()
+        self.resource = self.prepare_resource()
+        self.cache_policy = self.prepare_cache_policy()
+        # streamed responses are passed, as they arrive, to on_chunk(text)
+        self.stream = bool(self.data.get('stream'))
         # if the command spec from prompt forces a syntax, take that
         # otherwise, use the prompt var (i.e.: current syntax), or 'Markdown'
         if 'syntax' not in self.prompt.command:
             self.prompt.command['syntax'] = self.variables.get('syntax', 'Markdown')
+        self.metrics['prepare'] = time.perf_counter() - self.created
+
+    def setup(self, settings, prompt, endpoint, region, stack):
+        """
+        Sets the state of a request to the endpoint, before its payload is prepared.
+        Shared by single and batched requests (see AssistantBatchThread).
+        """
+        threading.Thread.__init__(self)
+        # timings per phase (see assistant_stats.PHASES) and payload sizes of the request
+        self.created = time.perf_counter()
+        self.submitted = None
+        self.metrics = {}
+        self.timeout = endpoint.timeout if endpoint.timeout else 60
+        self.queued = False
+        self.running = False
+        self.cancelled = threading.Event()
+        self.deadline = None
+        self.result = None
+        # called with this thread as argument when it's done
+        self.callbacks = []
+        self.settings = settings
+        self.prompt = prompt
+        self.endpoint = endpoint
+        self.region = region
+        self.stack = stack
+        # class in the dispatcher queue: prompts invoked by other prompts are chained
+        self.priority = prompt.priority or ('chained' if stack else 'interactive')
+        # the payload, once prepared
+        self.variables = {}
+        self.data = {}
+        self.query = {}
+        self.resource = ''
+        self.cache_policy = None
+        # estimated tokens
+        self.counter = counter_for(endpoint)
+        self.prompt_tokens = 0
+        self.tokens = 0
+        # only the values selected by the response paths are parsed
+        self.selector = endpoint.selector
+        self.stream = False
+        self.on_chunk = None
+        # the connection is taken from the pool when the thread runs
+        self.conn = None
+        # set by the engine sending the request instead of this thread (if any), aborts it
+        self.aborter = None
 
     def prepare_vars(self, text, pre, post, kwargs):
         """
@@ -51,13 +102,9 @@ class AssistantThread(threading.Thread):
             "post": post,
         }
         vars_.update(kwargs)
-        # expand vars as defined by prompt/vars
-        for k, v in self.prompt.variables.items():
-            # for convenience, in vars, user may specify
-            # each line as a string of an array
-            if isinstance(v, list):
-                v = '\n'.join(v)
-            vars_[k] = str(sublime.expand_variables(v, vars_))
+        # expand vars as defined by prompt/vars (compiled when loading the prompt)
+        for k, template in self.prompt.variable_templates.items():
+            vars_[k] = str(template.render(vars_))
         return vars_
 
     def prepare_data(self):
@@ -67,11 +114,10 @@ class AssistantThread(threading.Thread):
         Returns:
             data (dict): A dictionary containing the prepared data.
         """
-        request = {}
-        request.update(self.endpoint.request)
-        request.update(self.prompt.params)
-        for k, v in request.items():
-            request[k] = sublime.expand_variables(v, self.variables)
+        templates = {}
+        templates.update(self.endpoint.request_templates)
+        templates.update(self.prompt.params_templates)
+        request = dict((k, template.render(self.variables)) for k, template in templates.items())
         to_filter = set()
         for k, v in request.items():
             if k not in self.endpoint.valid_params:
@@ -79,6 +125,9 @@ class AssistantThread(threading.Thread):
                 print("AssistantAI: WARNING: prompt '{}' provides a param '{}' not accepted by endpoint '{}'.".format(
                     self.prompt.pid, k, self.endpoint.eid))
             # TODO: check valid_params specified type.
+        # i.e.: when a prompt disables 'stream'
+        if not request.get('stream'):
+            to_filter.update(self.endpoint.stream_params)
         return dict((k,v) for k,v in request.items() if k not in to_filter)
 
     def prepare_query(self):
@@ -88,17 +137,101 @@ class AssistantThread(threading.Thread):
         Returns:
             query (string): A URL encoded string containing the prepared payload.
         """
-        query = {}
-        query.update(self.endpoint.query)
-        query.update(self.prompt.query)
-        data = {}
-        for k, v in query.items():
-            data[k] = str(sublime.expand_variables(v, self.variables))
+        templates = {}
+        templates.update(self.endpoint.query_templates)
+        templates.update(self.prompt.query_templates)
+        data = dict((k, str(template.render(self.variables))) for k, template in templates.items())
         return urlencode(data)
 
+    def prepare_resource(self):
+        """
+        This function prepares the resource (path and query string) to be requested.
+
+        Returns:
+            resource (string): The expanded resource of the endpoint, with the query if any.
+        """
+        resource = str(self.endpoint.resource_template.render(self.variables))
+        if self.query:
+            resource = "{0}?{1}".format(resource, self.query)
+        return resource
+
+    def prepare_cache_policy(self):
+        """
+        Resolves if the response can be cached, as per the endpoint and prompt 'cache' options.
+        The prompt option overrides the endpoint one. Since a request to a sampling endpoint (one taking
+        a 'temperature') is only deterministic with a temperature of 0, and servers default to non zero
+        ones, such requests without it are not cached unless the policy sets 'any_temperature'.
+
+        Returns:
+            dict: The cache policy (i.e.: its 'ttl'), or None if the response must not be cached.
+        """
+        if self.prompt.cache is False:
+            return None
+        if self.prompt.cache is None and not isinstance(self.endpoint.cache, dict):
+            return None
+        policy = {}
+        policy.update(self.endpoint.cache or {})
+        policy.update(self.prompt.cache or {})
+        sampled = 'temperature' in self.data or 'temperature' in self.endpoint.valid_params
+        if sampled and self.data.get('temperature', 1) != 0 and not policy.get('any_temperature', False):
+            return None
+        return policy
+
+    def fit_context(self, text, pre, post, kwargs):
+        """
+        Estimates the tokens of the request: the prompt (payload) and the completion ('max_tokens').
+        If the endpoint has a 'context_window' and the request exceeds it, the vars listed in the
+        prompt 'trim' option are trimmed, in order, and the payload is prepared again.
+        """
+        completion = self.data.get('max_tokens')
+        completion = completion if isinstance(completion, int) else 0
+        self.prompt_tokens = self.counter.count_payload(self.data)
+        budget = self.endpoint.context_window - completion
+        trimmed = []
+        if self.endpoint.context_window:
+            context = {'text': text, 'pre': pre, 'post': post}
+            context.update(kwargs)
+            for name in self.prompt.trim:
+                # trimming is estimated, a few passes may be needed (i.e.: if the var is used twice)
+                for _ in range(3):
+                    excess = self.prompt_tokens - budget
+                    value = context.get(name)
+                    if excess <= 0 or name == 'text' or not value or not isinstance(value, str):
+                        break
+                    context[name] = trim_text(value, excess, self.counter, keep_end=(name == 'pre'))
+                    if name not in trimmed:
+                        trimmed.append(name)
+                    args = dict((k, v) for k, v in context.items() if k not in ('text', 'pre', 'post'))
+                    self.variables = self.prepare_vars(context['text'], context['pre'], context['post'], args)
+                    self.data = self.prepare_data()
+                    self.prompt_tokens = self.counter.count_payload(self.data)
+            if trimmed:
+                print("AssistantAI: Trimmed {} to fit the context window of '{}/{}'.".format(
+                    ', '.join(trimmed), self.endpoint.sid, self.endpoint.eid))
+            if self.prompt_tokens > budget:
+                print("AssistantAI: WARNING: the request to '{}/{}' (~{} tokens, and {} for the completion) "
+                    "may exceed its context window of {} tokens.".format(self.endpoint.sid, self.endpoint.eid,
+                    self.prompt_tokens, completion, self.endpoint.context_window))
+        self.tokens = self.prompt_tokens + completion
+
+    def count_tokens(self, result):
+        """
+        Adds the estimated and the actual prompt tokens to the result. The actual ones are only known if the
+        endpoint response has a 'prompt_tokens' path, and calibrate the estimations of the endpoint.
+        """
+        if not isinstance(result, dict) or result.get('error'):
+            return
+        tokens = {'estimated': self.prompt_tokens}
+        actual = result.get('prompt_tokens')
+        if isinstance(actual, int):
+            tokens['actual'] = actual
+            self.counter.calibrate(self.prompt_tokens, actual)
+        result['tokens'] = tokens
+
     def prepare_conn(self):
         """
-        Prepares the HTTP connection based on the endpoint URL.
+        Prepares a new HTTP connection based on the endpoint URL.
+        Used by the connection pool when there is no idle connection to reuse.
 
         Returns:
         http.client.HTTPConnection or http.client.HTTPSConnection: The suitable HTTP connection to be used for
@@ -111,51 +244,545 @@ class AssistantThread(threading.Thread):
         if not url.port:
             port = 443 if scheme == 'https' else 80
         if scheme == 'https':
-            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            if isinstance(self.endpoint.credentials, dict):
-                verify = self.endpoint.credentials.get('verify')
-                cert = self.endpoint.credentials.get('cert')
-                if verify:
-                    verify = str(os.path.expanduser(verify))
-                    context.load_verify_locations(cafile=verify)
-                    if cert:
-                        cert = str(os.path.expanduser(cert))
-                        context.load_cert_chain(cert)
-            return http.client.HTTPSConnection(hostname, port=port, context=context)
-        return http.client.HTTPConnection(hostname, port=port)
+            context = ssl_contexts.get(self.endpoint.credentials)
+            return http.client.HTTPSConnection(hostname, port=port, context=context, timeout=self.timeout)
+        return http.client.HTTPConnection(hostname, port=port, timeout=self.timeout)
 
     def run(self):
         """
-        Sets the 'running' attribute to True, gets a response using the 'get_response' method,
-        assigns the response to the 'result' attribute, and sets the 'running' attribute to False.
+        Sets the 'running' attribute to True, gets a response using the 'get_cached_response' method,
+        and finishes the thread with the response as result.
 
         Parameters:
         self: An instance of the class.
         """
         try:
             self.running = True
-            self.result = self.get_response()
-            self.running = False
+            self.deadline = time.time() + self.timeout
+            if self.submitted is not None:
+                self.metrics['queue'] = time.perf_counter() - self.submitted
+            result = self.get_cached_response()
         except Exception as e:
-            self.result = {'error': e}
-            print("AssistantAI: Error while processing prompt: {}".format(e))
-            self.running = False
+            result = self.error_result(e)
+        self.finish(result)
+
+    def error_result(self, e):
+        """
+        Returns the result of a request that failed with the given error.
+        """
+        if self.cancelled.is_set():
+            e = RequestCancelled("Request cancelled.")
+        elif isinstance(e, socket.timeout):
+            e = socket.timeout("Request ran out of time ({}s).".format(self.timeout))
+        print("AssistantAI: Error while processing prompt: {}".format(e))
+        return {'error': e}
+
+    def cancel(self):
+        """
+        Aborts the request. Shutting down the socket unblocks the thread if waiting for the server.
+        """
+        self.cancelled.set()
+        if self.aborter:
+            self.aborter()
+        conn = self.conn
+        sock = conn.sock if conn else None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def check_deadline(self):
+        """
+        Raises an error if the request is cancelled or ran out of time. Otherwise, sets the socket
+        timeout to the remaining time, so no blocking operation can exceed the request deadline.
+        """
+        if self.cancelled.is_set():
+            raise RequestCancelled("Request cancelled.")
+        remaining = self.deadline - time.time() if self.deadline else self.timeout
+        if remaining <= 0:
+            raise socket.timeout("Request ran out of time ({}s).".format(self.timeout))
+        if self.conn:
+            self.conn.timeout = remaining
+            if self.conn.sock:
+                self.conn.sock.settimeout(remaining)
+        return remaining
+
+    def connect(self):
+        """
+        Takes a connection from the pool, with the remaining time as socket timeout.
+        New connections are connected right away, timing the TCP connect and TLS handshake.
+        """
+        self.conn = pool.acquire(self.endpoint, self.prepare_conn, self.check_deadline())
+        self.check_deadline()
+        if self.conn.sock is None:
+            start = time.perf_counter()
+            self.conn.connect()
+            self.metrics['connect'] = self.metrics.get('connect', 0) + time.perf_counter() - start
+
+    def finish(self, result):
+        """
+        Sets the result, marks the thread as done, and calls the registered callbacks.
+        Also used to complete threads that are not run, since an identical request is in flight.
+        """
+        self.result = result
+        self.queued = False
+        self.running = False
+        for callback in self.callbacks:
+            callback(self)
+
+    def get_cached_response(self):
+        """
+        Returns the cached response for this same request if any, or gets it using 'get_response',
+        caching it if the cache policy allows it.
+        """
+        result = self.cached_result()
+        if result is not None:
+            return result
+        result = self.get_response()
+        self.count_tokens(result)
+        self.cache_result(result)
+        return result
+
+    def cached_result(self):
+        """
+        Returns the cached response for this same request, or None if not cached or the cache policy
+        doesn't allow it.
+        """
+        if self.cache_policy is None:
+            return None
+        return cache.get(fingerprint(self.endpoint, self.resource, self.query, self.data))
+
+    def cache_result(self, result):
+        """
+        Caches the result, if the cache policy allows it and it's not an error.
+        """
+        if self.cache_policy is None or result.get('error'):
+            return
+        # a cached result was already streamed to its view, not to the next one
+        cached = dict(result)
+        cached['streamed'] = False
+        key = fingerprint(self.endpoint, self.resource, self.query, self.data)
+        cache.put(key, cached, self.cache_policy.get('ttl'))
 
     def get_response(self):
         """
         Send a request to the endpoint specified in self.endpoint, with the data
-        specified in self.data, and return the parsed JSON response.
+        specified in self.data, and return the parsed JSON response, or the
+        concatenated text if the response is streamed.
+
+        Failed requests are retried as per the server 'retries' settings, with exponential
+        backoff, or waiting as long as the server asks with the 'Retry-After' header.
 
         :return: A dictionary containing the response data.
         :rtype: Dict[str, Any]
         """
-        data = json.dumps(self.data)
+        spec = {
+            'max': 2,
+            'backoff': 1,
+            'max_backoff': 30,
+            'statuses': [429, 503],
+        }
+        spec.update(self.endpoint.retries or {})
+        limiter = limiter_for(self.endpoint)
+        attempt = 0
+        while True:
+            try:
+                response, body, result = self.send()
+            except ConnectionRefusedError:
+                if attempt >= spec['max'] or self.cancelled.is_set():
+                    raise
+                delay = backoff(attempt, spec)
+            else:
+                limiter.update(response)
+                if response.status not in spec['statuses'] or attempt >= spec['max']:
+                    if result is not None:
+                        return result
+                    start = time.perf_counter()
+                    result = self.parse_body(response, body)
+                    self.metrics['extract'] = time.perf_counter() - start
+                    return result
+                delay = parse_retry_after(response.getheader('Retry-After'))
+                if delay is None:
+                    delay = backoff(attempt, spec)
+            delay = max(delay, limiter.blocked_for())
+            if delay >= self.check_deadline():
+                raise socket.timeout("Request ran out of time ({}s).".format(self.timeout))
+            attempt += 1
+            print("AssistantAI: Retrying request to '{}/{}' in {:.1f}s (attempt {}).".format(
+                self.endpoint.sid, self.endpoint.eid, delay, attempt))
+            if self.cancelled.wait(delay):
+                raise RequestCancelled("Request cancelled.")
+
+    def prepare_body(self):
+        """
+        Prepares the request body and headers. As per the server 'compression' settings, the response
+        may be compressed (gzip or deflate), and big request bodies are gzipped.
+        Streamed responses are not compressed, so each event can be handled as soon as it arrives.
+
+        Returns:
+            tuple: The body (bytes) and the headers (dict).
+        """
+        spec = {
+            'response': True,
+            'request': False,
+            'min_size': 1024,
+        }
+        spec.update(self.endpoint.compression or {})
+        headers = dict(self.endpoint.headers) if self.endpoint.headers else {}
+        data = json.dumps(self.data).encode('utf-8')
+        if not any(k.lower() == 'accept-encoding' for k in headers):
+            headers['Accept-Encoding'] = 'gzip, deflate' if spec['response'] and not self.stream else 'identity'
+        if spec['request'] and len(data) >= spec['min_size']:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        return data, headers
+
+    def send(self):
+        """
+        Sends the request once. If a cassette is recording, the response is recorded as it's read,
+        and if it's replaying, the recorded response is read instead of sending the request.
+
+        Returns:
+            tuple: The response, and its JSON document, or the result if the response is streamed.
+        """
+        data, headers = self.prepare_body()
         method = self.endpoint.method
-        resource = self.endpoint.resource
-        resource = str(sublime.expand_variables(resource, self.variables))
-        if self.query:
-            resource = "{0}?{1}".format(resource, self.query)
-        headers = self.endpoint.headers if self.endpoint.headers else {}
-        self.conn.request(method, resource, data, headers)
-        response = self.conn.getresponse()
-        return self.endpoint.parse_response(json.loads(response.read().decode()))
+        resource = self.resource
+        self.metrics['request_bytes'] = len(data)
+        request = None
+        if cassette.mode:
+            request = {
+                'key': request_key(self.endpoint, method, resource, self.data),
+                'endpoint': '{}/{}'.format(self.endpoint.sid, self.endpoint.eid),
+                'prompt': self.prompt.pid,
+                'method': method,
+                'resource': resource,
+                'data': self.data,
+            }
+        if cassette.mode == 'replay':
+            start = time.perf_counter()
+            response = cassette.replay(request, self.cancelled.wait)
+            self.metrics['ttfb'] = time.perf_counter() - start
+            body, result = self.read_body(response)
+            return response, body, result
+        self.connect()
+        try:
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, resource, data, headers)
+                response = self.conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                # a kept alive socket may be closed by the server while idle, retry once with a new one
+                if not self.conn.assistant_reused or self.cancelled.is_set():
+                    raise
+                pool.discard(self.conn)
+                self.conn = None
+                self.connect()
+                start = time.perf_counter()
+                self.conn.request(method, resource, data, headers)
+                response = self.conn.getresponse()
+            self.metrics['ttfb'] = time.perf_counter() - start
+            if request:
+                response = cassette.record(response, request, self.metrics['ttfb'])
+            body, result = self.read_body(response)
+        except Exception:
+            if self.conn:
+                pool.discard(self.conn)
+                self.conn = None
+            raise
+        if response.will_close:
+            pool.discard(self.conn)
+        else:
+            pool.release(self.conn)
+        self.conn = None
+        return response, body, result
+
+    def read_body(self, response):
+        """
+        Reads the response body: the JSON document, or the events if streamed.
+
+        Returns:
+            tuple: The JSON document, or None, and the result if the response is streamed, or None.
+        """
+        body = result = None
+        if response.getheader('Content-Type', '').startswith('text/event-stream'):
+            result = self.read_events(response)
+        else:
+            body = self.read_document(response)
+        # a cancelled response may be incomplete, and its socket is shut down
+        if self.cancelled.is_set():
+            raise RequestCancelled("Request cancelled.")
+        return body, result
+
+    def parse_body(self, response, document):
+        """
+        Parses the JSON document of the response as per the endpoint specification.
+        """
+        if document is None and response.status >= 400:
+            return {'error': "HTTP {} {}".format(response.status, response.reason)}
+        return self.endpoint.parse_response(document)
+
+    def read_document(self, response):
+        """
+        Reads the JSON document of the response, in chunks, within the request deadline.
+        Compressed bodies are decompressed as they are read.
+
+        Unless a response path selects the whole document, the body is parsed while it's read,
+        keeping only the values selected by the endpoint response paths.
+
+        The time reading the socket is the 'download' phase, and the rest (decompressing and parsing) the 'parse' one.
+
+        Returns:
+            The (maybe pruned) document, or None if the body is not JSON and the response is an HTTP error.
+        """
+        decoder = ContentDecoder(response.getheader('Content-Encoding'))
+        start = time.perf_counter()
+        self.metrics['download'] = 0
+        self.metrics['response_bytes'] = 0
+        def read():
+            while True:
+                self.check_deadline()
+                started = time.perf_counter()
+                chunk = response.read(65536)
+                self.metrics['download'] += time.perf_counter() - started
+                self.metrics['response_bytes'] += len(chunk)
+                if not chunk:
+                    return decoder.flush()
+                chunk = decoder.decompress(chunk)
+                if chunk:
+                    return chunk
+        try:
+            return self.parse_document(read)
+        except ValueError:
+            # read the rest of the body, so the connection can be reused
+            while read():
+                pass
+            if response.status >= 400:
+                return None
+            raise
+        finally:
+            self.metrics['parse'] = time.perf_counter() - start - self.metrics['download']
+
+    def parse_document(self, read):
+        """
+        Parses the JSON document read in chunks with read(), keeping only the values selected by
+        the endpoint response paths, unless a path selects the whole document.
+
+        Raises:
+            ValueError: If the body is not valid JSON.
+        """
+        if self.selector is None:
+            return json.loads(b''.join(iter(read, b'')).decode())
+        return PrunedJSONParser(self.selector, read).parse()
+
+    def read_events(self, response):
+        """
+        Reads a streamed response (server-sent events) until the server closes it.
+        The text of each event is passed to on_chunk, if set, as soon as it's received.
+
+        Returns:
+            dict: The response with the concatenated 'text' as 'output', and 'streamed' set to True
+            if any text was passed to on_chunk.
+        """
+        parser = EventStreamParser()
+        decoder = ContentDecoder(response.getheader('Content-Encoding'))
+        state = self.events_state()
+        start = time.perf_counter()
+        self.metrics['download'] = 0
+        self.metrics['response_bytes'] = 0
+        while True:
+            self.check_deadline()
+            started = time.perf_counter()
+            line = response.readline()
+            self.metrics['download'] += time.perf_counter() - started
+            self.metrics['response_bytes'] += len(line)
+            events = parser.feed(decoder.decompress(line)) if line else parser.feed(decoder.flush()) + parser.close()
+            for data in events:
+                self.handle_event(data, state)
+            if not line:
+                break
+        self.metrics['parse'] = time.perf_counter() - start - self.metrics['download']
+        return self.events_result(state)
+
+    def events_state(self):
+        """
+        Returns the state of the events of a streamed response: the text chunks, the error if any, if the
+        last event was received, and the JSON documents of the events merged (see merge_event).
+        """
+        return {'chunks': [], 'error': None, 'done': False, 'document': None}
+
+    def handle_event(self, data, state):
+        """
+        Handles the data of an event of a streamed response, passing its text to on_chunk.
+        Events after the last one ('[DONE]') or an error are ignored.
+        """
+        if state['done'] or state['error']:
+            return  # keep reading until the end, so the connection can be reused
+        if data.strip() == '[DONE]':
+            state['done'] = True
+            return
+        document = json.loads(data)
+        event = self.endpoint.parse_event(document)
+        state['document'] = merge_event(state['document'], document)
+        if event.get('error'):
+            state['error'] = event.get('error')
+            return
+        text = event.get('text')
+        if not text or not isinstance(text, str):
+            return
+        state['chunks'].append(text)
+        if self.on_chunk:
+            self.on_chunk(text)
+
+    def events_result(self, state):
+        """
+        Returns the result of a streamed response, given the state of its events. It's parsed as per the
+        endpoint response spec (output template, list, vars...) as a non streamed response, from the merged
+        documents of the events with the concatenated text at the 'text' path.
+        """
+        text = ''.join(state['chunks'])
+        document = state['document'] if isinstance(state['document'], dict) else {}
+        text_set = set_path(document, self.endpoint.response['paths']['text'], text)
+        result = self.endpoint.parse_response(document)
+        if not text_set:
+            result['text'] = text
+            result['output'] = self.endpoint.output_template.render(result)
+        if state['error']:
+            result['error'] = state['error']
+        result['streamed'] = bool(self.on_chunk and state['chunks'])
+        return result
+
+class AssistantBatchThread(AssistantThread):
+    """
+    Sends the requests of several threads as one, to an endpoint accepting an array of inputs
+    as per its 'batch' spec, and finishes each thread with its part of the response.
+    """
+    def __init__(self, threads):
+        first = threads[0]
+        self.setup(first.settings, first.prompt, first.endpoint, first.region, first.stack)
+        self.created = min(thread.created for thread in threads)
+        self.priority = first.priority
+        self.variables = first.variables
+        self.query = first.query
+        self.resource = first.resource
+        self.set_threads(threads)
+        # each thread is looked up in the cache when the batch runs, and cached when finished
+        self.cache_policy = next((t.cache_policy for t in threads if t.cache_policy is not None), None)
+        # the items of all threads are needed to split the response
+        self.selector = None
+
+    def set_threads(self, threads):
+        """
+        Sets the threads of the batch, and its payload: the one of the first thread, with the inputs
+        of all threads in the batch param.
+        """
+        param = self.endpoint.batch.get('param')
+        self.threads = threads
+        self.data = dict(threads[0].data) if threads else {}
+        self.data[param] = [thread.data.get(param) for thread in threads]
+        self.prompt_tokens = sum(thread.prompt_tokens for thread in threads)
+        self.tokens = sum(thread.tokens for thread in threads)
+
+    @staticmethod
+    def batch_key(thread):
+        """
+        Returns a key identifying the threads that can be batched together (same endpoint, resource and
+        payload but the batch param), or None if the thread can't be batched.
+        """
+        spec = thread.endpoint.batch
+        param = spec.get('param') if spec else None
+        if not param or not spec.get('items') or param not in thread.data or thread.stream:
+            return None
+        data = dict((k, v) for k, v in thread.data.items() if k != param)
+        return json.dumps([thread.endpoint.sid, thread.endpoint.eid, thread.resource, data],
+            sort_keys=True, default=str)
+
+    @staticmethod
+    def pack(threads):
+        """
+        Groups the threads in batches, up to the endpoint batch 'max_items' and 'max_tokens' (estimated).
+        Threads that can't be batched are returned alone.
+
+        Returns:
+            list: Lists of threads, in the order of the first thread of each.
+        """
+        batches = []
+        open_batches = {}
+        for thread in threads:
+            key = AssistantBatchThread.batch_key(thread)
+            if key is None:
+                batches.append([thread])
+                continue
+            spec = thread.endpoint.batch
+            max_items = max(1, spec.get('max_items', 16))
+            max_tokens = spec.get('max_tokens')
+            batch = open_batches.get(key)
+            if batch is not None:
+                tokens = sum(t.tokens for t in batch) + thread.tokens
+                if len(batch) < max_items and (not max_tokens or tokens <= max_tokens):
+                    batch.append(thread)
+                    continue
+            batch = [thread]
+            open_batches[key] = batch
+            batches.append(batch)
+        return batches
+
+    def cached_result(self):
+        """
+        Finishes the threads with a cached response, and leaves the others in the batch.
+
+        Returns:
+            dict: The (empty) results of the batch if all threads were cached, or None to send it.
+        """
+        threads = []
+        for thread in self.threads:
+            result = thread.cached_result()
+            if result is not None:
+                thread.finish(result)
+            else:
+                threads.append(thread)
+        if len(threads) < len(self.threads):
+            self.set_threads(threads)
+        return None if threads else {'results': []}
+
+    def cache_result(self, result):
+        """
+        Does nothing: each thread is cached as it's finished.
+        """
+        pass
+
+    def parse_body(self, response, document):
+        """
+        Parses the JSON document of the batched response, with one result per thread.
+        """
+        if document is None and response.status >= 400:
+            return {'error': "HTTP {} {}".format(response.status, response.reason)}
+        return {'results': self.endpoint.parse_batch_response(document, len(self.threads))}
+
+    def count_tokens(self, result):
+        """
+        Adds the estimated prompt tokens to the result of each thread. The actual ones, if reported,
+        are of the whole batch, and only calibrate the estimations of the endpoint.
+        """
+        results = result.get('results') if isinstance(result, dict) else None
+        if not results:
+            return
+        actual = results[0].get('prompt_tokens')
+        if isinstance(actual, int):
+            self.counter.calibrate(self.prompt_tokens, actual)
+        for thread, thread_result in zip(self.threads, results):
+            thread_result['tokens'] = {'estimated': thread.prompt_tokens}
+
+    def finish(self, result):
+        """
+        Finishes the batch, and then each thread with its result, or the error of the batch.
+        """
+        super().finish(result)
+        results = result.get('results') if isinstance(result, dict) else None
+        for i, thread in enumerate(self.threads):
+            # the timings of the batch are the ones of each thread, but its own preparation
+            thread.metrics.update((k, v) for k, v in self.metrics.items() if k != 'prepare')
+            thread_result = results[i] if results else {'error': result.get('error')}
+            thread.cache_result(thread_result)
+            thread.finish(thread_result)
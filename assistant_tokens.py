@@ -0,0 +1,123 @@
+import re
+import threading
+
+PIECES = re.compile(r'[A-Za-z]+|\d{1,3}|[ \t]*\n\s*|[ \t]{2,}|[^\sA-Za-z\d]')
+
+def estimate_chars(text):
+    """
+    Roughly 4 chars per token.
+    """
+    return (len(text) + 3) // 4
+
+def estimate_approx(text):
+    """
+    Approximates a BPE tokenizer: words (with their leading space) are one token, or more if long,
+    numbers are split every 3 digits, and each other symbol is a token.
+    """
+    tokens = 0
+    for m in PIECES.finditer(text):
+        size = m.end() - m.start()
+        if size > 6 and text[m.start()].isalpha():
+            tokens += 1 + (size - 1) // 6
+        else:
+            tokens += 1
+    return tokens
+
+# Local estimators of the tokens of a text, by name (see the endpoint 'tokenizer' setting).
+# Other plugins may register theirs with register_estimator.
+estimators = {
+    'chars': estimate_chars,
+    'approx': estimate_approx,
+}
+
+def register_estimator(name, estimator):
+    """
+    Registers a function estimating the tokens of a text, to be used by endpoints with that 'tokenizer'.
+    """
+    estimators[name] = estimator
+
+class TokenCounter(object):
+    """
+    Estimates the tokens of texts and request payloads for an endpoint, with a local estimator.
+
+    Estimations are corrected with the actual counts reported by the server, so they get closer
+    to the real tokenizer of the model with each response.
+    """
+    def __init__(self, tokenizer='approx'):
+        self.tokenizer = tokenizer
+        self.estimator = estimators.get(tokenizer)
+        if not self.estimator:
+            print("AssistantAI: WARNING: unknown tokenizer '{}', using 'approx'.".format(tokenizer))
+            self.estimator = estimate_approx
+        self.ratio = 1.0
+        self.lock = threading.Lock()
+
+    def count(self, text):
+        if not text:
+            return 0
+        return int(round(self.estimator(text) * self.ratio))
+
+    def count_payload(self, data):
+        """
+        Estimates the tokens of all strings of the payload, plus a few per object (i.e.: per chat message).
+        """
+        if isinstance(data, str):
+            return self.count(data)
+        if isinstance(data, dict):
+            return 3 + sum(self.count_payload(v) for v in data.values())
+        if isinstance(data, list):
+            return sum(self.count_payload(v) for v in data)
+        return 0
+
+    def calibrate(self, estimated, actual):
+        """
+        Corrects next estimations with the actual tokens of a request estimated as given.
+        """
+        if estimated <= 0 or actual <= 0:
+            return
+        with self.lock:
+            ratio = self.ratio * actual / estimated
+            self.ratio = min(4.0, max(0.25, self.ratio * 0.7 + ratio * 0.3))
+
+counters = {}
+counters_lock = threading.Lock()
+
+def counter_for(endpoint):
+    """
+    Returns the token counter of the endpoint. Recreated if its tokenizer changes.
+    """
+    key = (endpoint.sid, endpoint.eid)
+    with counters_lock:
+        counter = counters.get(key)
+        if not counter or counter.tokenizer != endpoint.tokenizer:
+            counter = TokenCounter(endpoint.tokenizer)
+            counters[key] = counter
+        return counter
+
+def minify(text):
+    """
+    Removes trailing spaces, and collapses consecutive blank lines.
+    """
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text)
+
+def trim_text(text, excess, counter, keep_end=False):
+    """
+    Trims the text by about 'excess' tokens: first minifying it, then cutting whole lines from its end
+    (or from its start if keep_end, i.e.: for the text before the selection).
+    """
+    text = minify(text)
+    tokens = counter.count(text)
+    target = tokens - excess
+    if target <= 0:
+        return ''
+    if target >= tokens:
+        return text
+    size = len(text) * target // tokens
+    if keep_end:
+        cut = text[len(text) - size:]
+        newline = cut.find('\n')
+        return cut[newline + 1:] if 0 <= newline < len(cut) - 1 else cut
+    cut = text[:size]
+    newline = cut.rfind('\n')
+    return cut[:newline] if newline > 0 else cut
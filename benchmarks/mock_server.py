@@ -0,0 +1,214 @@
+"""
+A stand-in for the OpenAI and Gitea APIs, with the response shapes the bundled endpoints expect.
+
+Run it alone to try prompts against it, or let benchmarks/run.py start it:
+
+    python benchmarks/mock_server.py --latency 0.05 --size 4096 --list-size 1000
+
+It prints the port it listens to ("port N"), and serves until killed.
+"""
+import os
+import ssl
+import sys
+import json
+import gzip
+import time
+import argparse
+import tempfile
+import subprocess
+import socketserver
+import http.server
+
+class MockServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog (5) resets connections, or delays them a second, with many concurrent requests
+    request_queue_size = 1024
+
+    def __init__(self, options):
+        super().__init__(('127.0.0.1', options.port), MockHandler)
+        self.options = options
+        # responses don't depend on the request, so they are built once
+        self.completion = json.dumps(completion(options.size)).encode('utf-8')
+        self.repos = json.dumps({'ok': True, 'data': [repo(i) for i in range(options.list_size)]}).encode('utf-8')
+        words = ('x' * max(1, options.size // max(1, options.chunks)))
+        self.events = [event(words) for _ in range(options.chunks)] + [b'data: [DONE]\n\n']
+
+    def handle_error(self, request, client_address):
+        # clients cancelling or timing out their requests close the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written apart, don't let Nagle wait for the ACK of the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(size) if size else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body.decode('utf-8')) if body else {}
+
+    def send_json(self, status, body):
+        options = self.server.options
+        time.sleep(options.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if options.gzip and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        options = self.server.options
+        time.sleep(options.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for data in self.server.events:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+            if options.chunk_delay:
+                time.sleep(options.chunk_delay)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        # requests always have a JSON body, even if empty, to be read for the next one on the connection
+        self.read_body()
+        if self.path.startswith('/api/v1/repos/search'):
+            return self.send_json(200, self.server.repos)
+        self.send_json(404, b'{"message": "not found"}')
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.startswith('/v1/chat/completions'):
+            if body.get('stream'):
+                return self.send_events()
+            return self.send_json(200, self.server.completion)
+        if self.path.startswith('/api/v1/repos/') and self.path.endswith('/issues'):
+            repo_name = self.path[len('/api/v1/repos/'):-len('/issues')]
+            return self.send_json(201, json.dumps(issue(repo_name, body)).encode('utf-8'))
+        self.send_json(404, b'{"message": "not found"}')
+
+def completion(size):
+    return {
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion',
+        'created': 1680000000,
+        'model': 'gpt-4',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': 'x' * size},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 120, 'completion_tokens': size // 4, 'total_tokens': 120 + size // 4},
+    }
+
+def event(text):
+    data = {
+        'id': 'chatcmpl-mock',
+        'object': 'chat.completion.chunk',
+        'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+    }
+    return 'data: {}\n\n'.format(json.dumps(data)).encode('utf-8')
+
+def user(i):
+    return {
+        'id': i,
+        'login': 'user{}'.format(i),
+        'full_name': 'User {}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'avatar_url': 'http://localhost:3000/avatars/{}'.format(i),
+        'language': 'en-US',
+        'is_admin': False,
+        'created': '2023-01-01T00:00:00Z',
+    }
+
+def repo(i):
+    owner = user(i % 50)
+    name = 'repo{}'.format(i)
+    return {
+        'id': i,
+        'owner': owner,
+        'name': name,
+        'full_name': '{}/{}'.format(owner['login'], name),
+        'description': 'Mock repository number {} with a description of average length.'.format(i),
+        'empty': False,
+        'private': i % 3 == 0,
+        'fork': False,
+        'html_url': 'http://localhost:3000/{}/{}'.format(owner['login'], name),
+        'ssh_url': 'git@localhost:{}/{}.git'.format(owner['login'], name),
+        'clone_url': 'http://localhost:3000/{}/{}.git'.format(owner['login'], name),
+        'stars_count': i % 17,
+        'forks_count': i % 5,
+        'open_issues_count': i % 11,
+        'default_branch': 'main',
+        'archived': False,
+        'created_at': '2023-01-01T00:00:00Z',
+        'updated_at': '2023-04-01T00:00:00Z',
+        'permissions': {'admin': True, 'push': True, 'pull': True},
+        'topics': ['mock', 'benchmark'],
+    }
+
+def issue(repo_name, body):
+    return {
+        'id': 1,
+        'number': 1,
+        'url': 'http://localhost:3000/api/v1/repos/{}/issues/1'.format(repo_name),
+        'html_url': 'http://localhost:3000/{}/issues/1'.format(repo_name),
+        'user': user(1),
+        'title': body.get('title', ''),
+        'body': body.get('body', ''),
+        'state': 'open',
+        'comments': 0,
+        'created_at': '2023-04-01T00:00:00Z',
+    }
+
+def self_signed_cert(path):
+    """
+    Creates a self-signed certificate for localhost with the openssl command, and returns its path.
+    """
+    cert = os.path.join(path, 'mock.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-keyout', cert, '-out', cert],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI and Gitea API server.")
+    parser.add_argument('--port', type=int, default=0, help="port to listen to (default: any free one)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before each response")
+    parser.add_argument('--size', type=int, default=1024, help="chars of each completion")
+    parser.add_argument('--chunks', type=int, default=32, help="events of each streamed completion")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed events")
+    parser.add_argument('--list-size', type=int, default=100, help="repos returned by the repos search")
+    parser.add_argument('--gzip', action='store_true', help="gzip responses if the client accepts it")
+    parser.add_argument('--https', action='store_true', help="serve HTTPS, with a self-signed certificate")
+    return parser.parse_args(args)
+
+def main(args=None):
+    options = parse_args(args)
+    server = MockServer(options)
+    if options.https:
+        cert = self_signed_cert(tempfile.mkdtemp(prefix='assistant_ai_bench_'))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        print("cert {}".format(cert))
+    print("port {}".format(server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+"""
+End-to-end benchmarks of the request pipeline against a local mock of the OpenAI and Gitea APIs.
+
+The plugin modules run headless (with the stub 'sublime' module in benchmarks/stubs), loading the
+bundled settings files with their servers pointing to the mock server (see mock_server.py).
+Requests go through the Dispatcher and AssistantThread, as when prompted from a view.
+
+    python benchmarks/run.py                      # all scenarios
+    python benchmarks/run.py single fanout --requests 500 --latency 0.02
+    python benchmarks/run.py --save before.json   # then, after a change:
+    python benchmarks/run.py --compare before.json
+    python benchmarks/run.py replay --cassette session.jsonl.gz --replay-speed 10
+
+With --record, the responses are recorded to a cassette (see assistant_cassette.py), and with --cassette
+they are replayed from it instead of requesting the mock server. The 'replay' scenario sends the requests
+recorded in the cassette (i.e.: by the 'cassette' setting in Sublime Text) as they were sent.
+
+Each scenario reports requests per second, p50/p99 latencies, and the peak memory allocated by
+Python (traced in a second, shorter pass, since tracing slows it down).
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import types
+import argparse
+import threading
+import importlib
+import subprocess
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+PKG_NAME = 'AssistantAI'
+
+sys.path.insert(0, os.path.join(HERE, 'stubs'))
+import sublime
+
+# plugin modules, imported by load_package
+plugin = types.SimpleNamespace()
+
+# prompts of the benchmarks, along with the bundled ones
+BENCH_PROMPTS = [
+    {
+        "id": "bench_complete",
+        "required_inputs": ["text"],
+        "required_endpoints": ["openai/chat_completions"],
+        "vars": {"text": ["Continue the following ${syntax} code.", "", "${text}"]},
+        "params": {"stream": False, "max_tokens": 256},
+        "cache": False,
+        "command": "append",
+    },
+    {
+        "id": "bench_stream",
+        "import": "bench_complete",
+        "params": {"stream": True, "max_tokens": 256},
+    },
+    {
+        "id": "bench_repos",
+        "required_inputs": ["search_repo"],
+        "required_endpoints": ["gitea/repos_search"],
+        "cache": False,
+        "command": "append",
+    },
+]
+
+CODE = '\n'.join('def function_{0}(x):\n    return x * {0}\n'.format(i) for i in range(40))
+
+JSON_COMMENTS = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.S)
+JSON_TRAILING_COMMAS = re.compile(r'("(?:\\.|[^"\\])*")|,(?=\s*[\]}])')
+
+def read_settings(path):
+    """
+    Reads a sublime-settings file: JSON with comments and trailing commas.
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    text = JSON_COMMENTS.sub(lambda m: m.group(1) or '', text)
+    return json.loads(JSON_TRAILING_COMMAS.sub(lambda m: m.group(1) or '', text))
+
+def load_package():
+    """
+    Imports the plugin modules as the AssistantAI package, as Sublime Text does.
+    """
+    package = types.ModuleType(PKG_NAME)
+    package.__path__ = [ROOT]
+    sys.modules[PKG_NAME] = package
+    for name in ('assistant_settings', 'assistant_thread', 'assistant_dispatch', 'assistant_http', 'assistant_stats',
+            'assistant_cassette', 'assistant_cache', 'assistant_engine'):
+        setattr(plugin, name, importlib.import_module('{}.{}'.format(PKG_NAME, name)))
+    plugin.engine = plugin.assistant_engine.AsyncEngine()
+
+def load_settings(url, cert=None, cassette=None, engine='threads'):
+    """
+    Loads the bundled settings, with all servers pointing to the given URL, and the benchmark prompts.
+    """
+    resources = {}
+    for path in sorted(glob.glob(os.path.join(ROOT, 'assistant_ai*.sublime-settings'))):
+        data = read_settings(path)
+        credentials = {}
+        for server in data.get('default_servers', []):
+            server['url'] = url
+            credentials[server['id']] = {'api_key': 'mock', 'token': 'mock'}
+            if cert:
+                credentials[server['id']]['verify'] = cert
+        data['credentials'] = credentials
+        resources[os.path.basename(path)] = data
+    resources['assistant_ai_bench.sublime-settings'] = {'prompts': BENCH_PROMPTS}
+    if cassette:
+        resources['assistant_ai.sublime-settings']['cassette'] = cassette
+    resources['assistant_ai.sublime-settings']['engine'] = engine
+    sublime.resources = resources
+    settings = plugin.assistant_settings.AssistantAISettings()
+    settings.load()
+    return settings
+
+class MockServerProcess(object):
+    """
+    Runs mock_server.py in another process, so it doesn't compete for the GIL nor count in the memory peak.
+    """
+    def __init__(self, args):
+        command = [sys.executable, os.path.join(HERE, 'mock_server.py')] + args
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        self.cert = None
+        self.port = None
+        while self.port is None:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError("The mock server didn't start.")
+            key, _, value = line.strip().partition(' ')
+            if key == 'cert':
+                self.cert = value
+            elif key == 'port':
+                self.port = int(value)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+class Bench(object):
+    """
+    The settings and dispatcher of a scenario run, with the helpers to make and run threads.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.dispatcher = plugin.assistant_dispatch.Dispatcher(settings, plugin.engine)
+        self.errors = 0
+
+    def thread(self, pid, eid, text='', **kwargs):
+        kwargs.setdefault('syntax', 'Python')
+        region = sublime.Region(0, len(text))
+        prompt = self.settings.prompts[pid]
+        endpoint = self.settings.endpoints[eid]
+        return plugin.assistant_thread.AssistantThread(self.settings, prompt, endpoint, region, text, '', '', [], kwargs)
+
+    def run(self, threads):
+        """
+        Submits the threads at once, and waits for all of them.
+
+        Returns:
+            list: The results of the threads.
+        """
+        done = threading.Semaphore(0)
+        for thread in threads:
+            thread.callbacks.append(lambda thread: done.release())
+            self.dispatcher.submit(thread)
+        for _ in threads:
+            done.acquire()
+        for thread in threads:
+            self.record(thread)
+        return [thread.result for thread in threads]
+
+    def record(self, thread):
+        error = thread.result.get('error') if isinstance(thread.result, dict) else "No result."
+        if error:
+            self.errors += 1
+        if 'ttfb' in thread.metrics:
+            metrics = dict(thread.metrics)
+            metrics['total'] = time.perf_counter() - thread.created
+            endpoint = "{}/{}".format(thread.endpoint.sid, thread.endpoint.eid)
+            plugin.assistant_stats.stats.record(endpoint, thread.prompt.pid, metrics, error)
+
+# Scenarios: each runs 'count' operations, returning the latency of each one.
+
+def scenario_single(bench, count, options):
+    """One request at a time (a prompt on a single selection)."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        bench.run([bench.thread('bench_complete', 'openai/chat_completions', CODE)])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def scenario_stream(bench, count, options):
+    """One streamed request at a time, handling each chunk as it arrives."""
+    latencies = []
+    for _ in range(count):
+        chunks = []
+        thread = bench.thread('bench_stream', 'openai/chat_completions', CODE)
+        thread.on_chunk = chunks.append
+        start = time.perf_counter()
+        bench.run([thread])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def scenario_fanout(bench, count, options):
+    """Prompts on many selections at once, 'fanout' requests in flight each time."""
+    latencies = []
+    while len(latencies) < count:
+        size = min(options.fanout, count - len(latencies))
+        # each selection has its own text, or the dispatcher would send just one request
+        threads = [bench.thread('bench_complete', 'openai/chat_completions', '{}\n# {}'.format(CODE, i))
+            for i in range(size)]
+        start = time.perf_counter()
+        bench.run(threads)
+        latencies += [time.perf_counter() - start] * size
+    return latencies
+
+def scenario_chained(bench, count, options):
+    """A prompt taking an input from another one (repos list, then new issue), as 'gitea_post_issue'."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        result = bench.run([bench.thread('bench_repos', 'gitea/repos_search', search_repo=' ')])[0]
+        repo = result.get('list')[0][0] if result.get('list') else 'user0/repo0'
+        bench.run([bench.thread('gitea_post_issue', 'gitea/issue_post', CODE, repo=repo,
+            title="Benchmark issue", body="Created by the benchmarks.", file_name='bench.py',
+            file_relpath='bench.py', region_lines='L1-L80')])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def scenario_large_list(bench, count, options):
+    """A request listing many repos ('list_size'), with all items extracted as a list input."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        # not the search of the chained scenario, so cassettes keep both responses apart
+        bench.run([bench.thread('bench_repos', 'gitea/repos_search', search_repo='large')])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def scenario_priority(bench, count, options):
+    """One interactive request at a time, while 'fanout' background requests are queued."""
+    latencies = []
+    for i in range(count):
+        done = threading.Semaphore(0)
+        background = [bench.thread('bench_complete', 'openai/chat_completions', '{}\n# {} {}'.format(CODE, i, j))
+            for j in range(options.fanout)]
+        for thread in background:
+            thread.callbacks.append(lambda thread: done.release())
+            bench.dispatcher.submit(thread, priority='background')
+        start = time.perf_counter()
+        bench.run([bench.thread('bench_complete', 'openai/chat_completions', '{}\n# {}'.format(CODE, i))])
+        latencies.append(time.perf_counter() - start)
+        for thread in background:
+            done.acquire()
+    return latencies
+
+def scenario_replay(bench, count, options):
+    """The requests recorded in the cassette (--cassette), in turns, as they were sent."""
+    Prompt = plugin.assistant_settings.Prompt
+    requests = []
+    for interactions in plugin.assistant_cassette.cassette.interactions.values():
+        request = interactions[0]['request']
+        if request['endpoint'] in bench.settings.endpoints:
+            requests.append(request)
+    if not requests:
+        raise RuntimeError("No request in the cassette is for a bundled endpoint.")
+    latencies = []
+    for i in range(count):
+        request = requests[i % len(requests)]
+        prompt = bench.settings.prompts.get(request['prompt']) or Prompt({'id': request['prompt']})
+        endpoint = bench.settings.endpoints[request['endpoint']]
+        thread = plugin.assistant_thread.AssistantThread(bench.settings, prompt, endpoint, sublime.Region(0),
+            '', '', '', [], {})
+        # the recorded payload, instead of the one of the prompt
+        thread.data = request['data']
+        thread.resource = request['resource']
+        thread.stream = bool(thread.data.get('stream'))
+        thread.cache_policy = None
+        start = time.perf_counter()
+        bench.run([thread])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# scenario -> (function, mock server arguments, operations as per the options)
+SCENARIOS = {
+    'single': (scenario_single, lambda o: [], lambda o: o.requests),
+    'stream': (scenario_stream, lambda o: ['--chunk-delay', str(o.chunk_delay)], lambda o: o.requests),
+    'fanout': (scenario_fanout, lambda o: [], lambda o: o.requests),
+    'chained': (scenario_chained, lambda o: ['--list-size', '20'], lambda o: o.requests),
+    'large_list': (scenario_large_list, lambda o: ['--list-size', str(o.list_size)], lambda o: o.list_requests),
+    'priority': (scenario_priority, lambda o: [], lambda o: o.list_requests),
+    'replay': (scenario_replay, lambda o: [], lambda o: o.requests),
+}
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run_scenario(name, options):
+    function, server_args, operations = SCENARIOS[name]
+    args = ['--latency', str(options.latency), '--size', str(options.size)] + server_args(options)
+    if options.https:
+        args.append('--https')
+    if options.gzip:
+        args.append('--gzip')
+    server = MockServerProcess(args)
+    try:
+        scheme = 'https' if options.https else 'http'
+        cassette = None
+        if options.cassette:
+            cassette = {'mode': 'replay', 'path': options.cassette, 'speed': options.replay_speed}
+        elif options.record:
+            cassette = {'mode': 'record', 'path': options.record}
+        settings = load_settings('{}://127.0.0.1:{}'.format(scheme, server.port), server.cert, cassette, options.engine)
+        count = operations(options)
+        # warm up (connections, SSL contexts and compiled paths)
+        function(Bench(settings), 1, options)
+        plugin.assistant_stats.stats.clear()
+        bench = Bench(settings)
+        start = time.perf_counter()
+        latencies = function(bench, count, options)
+        elapsed = time.perf_counter() - start
+        phases = plugin.assistant_stats.stats.report()
+        peak = None
+        if options.memory:
+            tracemalloc.start()
+            function(Bench(settings), min(count, 20), options)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        plugin.assistant_http.pool.close_all()
+        plugin.engine.stop()
+        server.stop()
+    return {
+        'requests': count,
+        'errors': bench.errors,
+        'rps': count / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'peak_kb': peak / 1024.0 if peak is not None else None,
+    }, phases
+
+def format_row(name, result, baseline=None):
+    def delta(key, lower_is_better):
+        if not baseline or not baseline.get(key) or result.get(key) is None:
+            return ''
+        change = (result[key] - baseline[key]) * 100.0 / baseline[key]
+        better = change < 0 if lower_is_better else change > 0
+        return ' ({:+.0f}%{})'.format(change, '' if abs(change) < 5 else ' better' if better else ' worse')
+    def ms(value):
+        return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+    return "{:<12}{:>7}{:>7}{:>10}{:>11}{:>11}{:>11}  {}{}{}".format(name, result['requests'], result['errors'],
+        '{:.1f}'.format(result['rps']), ms(result['p50']), ms(result['p99']),
+        '-' if result['peak_kb'] is None else '{:.0f}KB'.format(result['peak_kb']),
+        delta('rps', False), delta('p99', True), delta('peak_kb', True))
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="AssistantAI request pipeline benchmarks.")
+    parser.add_argument('scenarios', nargs='*', help="scenarios to run: {} (default: all)".format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--requests', type=int, default=100, help="requests (or chains) per scenario")
+    parser.add_argument('--list-requests', type=int, default=10, help="requests of the large_list scenario")
+    parser.add_argument('--list-size', type=int, default=2000, help="items of the large_list responses")
+    parser.add_argument('--fanout', type=int, default=16, help="selections prompted at once in fanout, background requests in priority")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the server waits before responding")
+    parser.add_argument('--size', type=int, default=4096, help="chars of each completion")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--https', action='store_true', help="use HTTPS (needs the openssl command)")
+    parser.add_argument('--gzip', action='store_true', help="let the server gzip its responses")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help="engine sending the requests")
+    parser.add_argument('--record', help="record the responses to this cassette file")
+    parser.add_argument('--cassette', help="replay the responses from this cassette file")
+    parser.add_argument('--replay-speed', type=float, default=0, help="speed of the replay (default 0: no waits)")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip the memory pass")
+    parser.add_argument('--phases', action='store_true', help="show the timings per phase of each scenario")
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="compare with the results saved in this JSON file")
+    options = parser.parse_args(args)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario '{}'".format(name))
+    if 'replay' in options.scenarios and not options.cassette:
+        parser.error("the replay scenario needs a --cassette")
+    if not options.scenarios:
+        options.scenarios = sorted(name for name in SCENARIOS if name != 'replay' or options.cassette)
+    return options
+
+def main(args=None):
+    options = parse_args(args)
+    load_package()
+    baseline = {}
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = {}
+    print("{:<12}{:>7}{:>7}{:>10}{:>11}{:>11}{:>11}".format('scenario', 'reqs', 'errors', 'req/s', 'p50', 'p99', 'peak'))
+    for name in options.scenarios:
+        results[name], phases = run_scenario(name, options)
+        print(format_row(name, results[name], baseline.get(name)))
+        if options.phases:
+            print(phases)
+        sys.stdout.flush()
+    if options.save:
+        with open(options.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 1 if any(result['errors'] for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+The bits of the Sublime Text API used by the request pipeline, to run it headless in benchmarks.
+"""
+import os
+import fnmatch
+import tempfile
+import threading
+
+CACHE_PATH = os.path.join(tempfile.gettempdir(), 'assistant_ai_bench_cache')
+# settings files, by name, as returned by load_settings (set by the benchmarks)
+resources = {}
+
+def version():
+    return "4143"
+
+def cache_path():
+    return CACHE_PATH
+
+def find_resources(pattern):
+    return ['Packages/AssistantAI/{}'.format(name) for name in sorted(resources) if fnmatch.fnmatch(name, pattern)]
+
+def load_settings(name):
+    return Settings(resources.get(name, {}))
+
+def status_message(message):
+    pass
+
+def set_timeout(callback, delay=0):
+    timer = threading.Timer(delay / 1000.0, callback)
+    timer.daemon = True
+    timer.start()
+
+set_timeout_async = set_timeout
+
+class Settings(dict):
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def __len__(self):
+        return self.end() - self.begin()
@@ -0,0 +1,75 @@
+"""
+Differential tests of the pruned JSON parser: every path must resolve the same in the pruned
+document as in the whole one.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import types
+import unittest
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PKG_NAME = 'AssistantAI'
+
+def load_module(name):
+    # the plugin modules are a package, as Sublime Text imports them
+    if PKG_NAME not in sys.modules:
+        package = types.ModuleType(PKG_NAME)
+        package.__path__ = [ROOT]
+        sys.modules[PKG_NAME] = package
+    return importlib.import_module('{}.{}'.format(PKG_NAME, name))
+
+jsonpath = load_module('assistant_jsonpath')
+qdict = load_module('assistant_qdict')
+
+DOCUMENT = {
+    'id': 'chatcmpl-1',
+    'choices': [
+        {'index': 0, 'message': {'role': 'assistant', 'content': 'a'}, 'text': 'a'},
+        {'index': 1, 'message': {'role': 'assistant', 'content': 'b'}, 'text': 'b'},
+    ],
+    'data': [{'id': i, 'full_name': 'user/repo{}'.format(i), 'owner': {'login': 'user{}'.format(i % 3)}}
+        for i in range(12)],
+    'usage': {'prompt_tokens': 10, 'total_tokens': 20},
+    'a/b': {'c': 1},
+    'error': None,
+}
+
+PATHS = [
+    'choices/0/text', 'choices/1/message/content', 'choices/-1/text', 'choices/01/text', 'choices/-2/message',
+    'choices/ 1/text', 'choices/9/text', 'data/*', 'data/*/full_name', 'data/11/owner/login', 'data/-1/owner/login',
+    'data/*[id > 9]/full_name', 'data/**/login', "'a/b'/c", 'usage/prompt_tokens', 'error', 'missing/0', '*',
+]
+
+def parse(selector, body, size=7):
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    return jsonpath.PrunedJSONParser(selector, lambda: chunks.pop(0) if chunks else b'').parse()
+
+class TestPrunedParser(unittest.TestCase):
+    def assertSameResults(self, paths, document=DOCUMENT):
+        body = json.dumps(document).encode('utf-8')
+        selector = jsonpath.compile_selector(paths)
+        pruned = parse(selector, body) if selector is not None else json.loads(body.decode('utf-8'))
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(qdict.QDict(pruned).values(path), qdict.QDict(document).values(path))
+
+    def test_each_path(self):
+        for path in PATHS:
+            self.assertSameResults([path])
+
+    def test_all_paths(self):
+        self.assertSameResults(PATHS)
+
+    def test_non_canonical_indexes(self):
+        self.assertEqual(qdict.QDict(DOCUMENT).get('choices/-1/text'), 'b')
+        self.assertSameResults(['choices/-1/text', 'choices/0/text'])
+        # an index at the root can't be pruned at all
+        self.assertIsNone(jsonpath.compile_selector(['-1/text']))
+        self.assertSameResults(['-1', '0'], document=['x', 'y'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Tests of QDict queries, and differential tests of the PathIndex and PathTrie (extract): both must give
+the same results as querying each path of the document.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import types
+import random
+import unittest
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PKG_NAME = 'AssistantAI'
+
+def load_module(name):
+    # the plugin modules are a package, as Sublime Text imports them
+    if PKG_NAME not in sys.modules:
+        package = types.ModuleType(PKG_NAME)
+        package.__path__ = [ROOT]
+        sys.modules[PKG_NAME] = package
+    return importlib.import_module('{}.{}'.format(PKG_NAME, name))
+
+qdict = load_module('assistant_qdict')
+
+DOCUMENT = {
+    'falsy': [0, '', None, False, {'x': 0}],
+    'usage': {'prompt_tokens': 0, 'model': ''},
+    'data': [{'id': i, 'state': 'open' if i % 2 else 'closed', 'owner': {'login': 'user{}'.format(i)}}
+        for i in range(5)],
+    'empty': [],
+}
+
+KEYS = ['a', 'b', 'c', '0', '1', '2', '*', '**', 'state', 'id']
+
+def random_value(rnd, depth=0):
+    r = rnd.random()
+    if depth > 3 or r < 0.3:
+        return rnd.choice([0, 1, '', 'a', None, False, True, 2.5, 'open'])
+    if r < 0.65:
+        return dict((rnd.choice(['a', 'b', 'c', 'state', 'id', 'x.y', 'a/b']), random_value(rnd, depth + 1))
+            for _ in range(rnd.randint(1, 4)))
+    return [random_value(rnd, depth + 1) for _ in range(rnd.randint(1, 4))]
+
+def random_path(rnd):
+    path = '/'.join(rnd.choice(KEYS) for _ in range(rnd.randint(1, 4)))
+    if rnd.random() < 0.2:
+        # filters by names every item has, as missing keys are reported
+        path += rnd.choice(["[_item == 'open']", "[_key == 'a']", "[_item]"])
+    return path
+
+def random_documents(seed, count=1000):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        yield rnd, {'a': random_value(rnd), 'b': random_value(rnd), 'c': [random_value(rnd), random_value(rnd)]}
+
+class TestQDict(unittest.TestCase):
+    def setUp(self):
+        self.q = qdict.QDict(DOCUMENT)
+
+    def test_get_first_match(self):
+        self.assertEqual(self.q.get('data/0/id'), 0)
+        # paths with wildcards or filters get their first match
+        self.assertEqual(self.q.get('data/*/id'), 0)
+        self.assertEqual(self.q.get("data/*[state == 'open']/owner/login"), 'user1')
+        self.assertIsNone(self.q.get('data/*/missing'))
+
+    def test_out_of_range_indexes(self):
+        for path in ('falsy/9', 'falsy/-9', 'empty/0', 'data/9/id', 'usage/0'):
+            with self.subTest(path=path):
+                self.assertIsNone(self.q.get(path))
+                self.assertEqual(self.q.values(path), [])
+                self.assertFalse(self.q.exists(path))
+        self.assertEqual(self.q.get('data/-1/id'), 4)
+
+    def test_falsy_items(self):
+        self.assertEqual(self.q.values('falsy/*'), [0, '', None, False, {'x': 0}])
+        self.assertEqual(self.q.find('usage/*'), {'usage/prompt_tokens': 0, 'usage/model': ''})
+        self.assertEqual(self.q.get('usage/prompt_tokens'), 0)
+        self.assertEqual(self.q.values('falsy/*/x'), [0])
+
+    def test_first_and_exists(self):
+        self.assertEqual(self.q.first('falsy/*'), 0)
+        self.assertEqual(self.q.first('missing', default='default'), 'default')
+        # a falsy value still exists
+        self.assertTrue(self.q.exists('usage/prompt_tokens'))
+        self.assertTrue(self.q.exists('falsy/2'))
+        self.assertFalse(self.q.exists('usage/completion_tokens'))
+
+    def test_limit(self):
+        self.assertEqual(self.q.values('data/*/id', limit=2), [0, 1])
+        self.assertEqual(self.q.paths('data/*/id', limit=0), [])
+        self.assertEqual(self.q.find("data/*[state == 'open']/id", limit=1), {'data/1/id': 1})
+        matches = self.q.iter('data/*/id')
+        self.assertEqual(next(matches), ('data/0/id', 0))
+        self.assertEqual(len(list(matches)), 4)
+
+class TestDifferential(unittest.TestCase):
+    def test_index(self):
+        for rnd, document in random_documents(1):
+            path = random_path(rnd)
+            with self.subTest(path=path, document=document):
+                expected = qdict.QDict(document).find(path)
+                self.assertEqual(qdict.QDict(document, index=True).find(path), expected)
+
+    def test_extract(self):
+        for rnd, document in random_documents(2):
+            targets = dict(('t{}'.format(i), random_path(rnd)) for i in range(rnd.randint(1, 5)))
+            many = [name for name, path in targets.items() if '*' in path]
+            q = qdict.QDict(document)
+            expected = dict((name, q.values(path) if name in many else q.get(path)) for name, path in targets.items())
+            with self.subTest(targets=targets, document=document):
+                self.assertEqual(q.extract(qdict.compile_trie(targets, many)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Tests of the request pipeline (dispatcher, engines and cache) against the mock server of the benchmarks.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import run
+
+run.load_package()
+
+class RequestsTestCase(unittest.TestCase):
+    engine = 'threads'
+    latency = '0.05'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = run.MockServerProcess(['--latency', cls.latency])
+        cls.settings = run.load_settings('http://127.0.0.1:{}'.format(cls.server.port), engine=cls.engine)
+        cls.bench = run.Bench(cls.settings)
+
+    @classmethod
+    def tearDownClass(cls):
+        run.plugin.engine.stop()
+        cls.server.stop()
+
+    def wait(self, thread):
+        """
+        Returns an event set when the thread finishes.
+        """
+        finished = threading.Event()
+        thread.callbacks.append(lambda thread: finished.set())
+        return finished
+
+class TestPayload(RequestsTestCase):
+    def test_stream_params(self):
+        streamed = self.bench.thread('bench_stream', 'openai/chat_completions', 'streamed')
+        self.assertEqual(streamed.data.get('stream_options'), {'include_usage': True})
+        # the prompt disables 'stream', so the endpoint 'stream_params' are not sent
+        thread = self.bench.thread('bench_complete', 'openai/chat_completions', 'not streamed')
+        self.assertNotIn('stream_options', thread.data)
+
+class TestCache(RequestsTestCase):
+    def setUp(self):
+        run.plugin.assistant_cache.cache.clear()
+
+    def test_get_endpoint_cached(self):
+        # no temperature to sample with, so its cache policy applies as it is
+        threads = [self.bench.thread('gitea_get_repo', 'gitea/repos_search', search_repo='cached') for _ in range(2)]
+        self.assertEqual(threads[0].cache_policy, {'ttl': 300})
+        first = self.bench.run(threads[:1])[0]
+        second = self.bench.run(threads[1:])[0]
+        self.assertFalse(first.get('error'))
+        self.assertEqual(second.get('text'), first.get('text'))
+        self.assertIn('ttfb', threads[0].metrics)
+        self.assertNotIn('ttfb', threads[1].metrics)
+
+    def test_batch_cached_when_run(self):
+        endpoint = self.settings.endpoints['openai/chat_completions']
+        endpoint.batch = {'param': 'messages', 'items': 'choices'}
+        self.addCleanup(setattr, endpoint, 'batch', {})
+        threads = [self.bench.thread('bench_complete', 'openai/chat_completions', 'batched {}'.format(i))
+            for i in range(3)]
+        for i, thread in enumerate(threads):
+            thread.cache_policy = {}
+            if i:
+                thread.cache_result({'text': 'cached {}'.format(i)})
+        batch = run.plugin.assistant_thread.AssistantBatchThread(threads)
+        # the cache is read when the batch runs, finishing the cached threads, and sending the others
+        self.assertIsNone(threads[1].result)
+        self.assertIsNone(batch.cached_result())
+        self.assertEqual([thread.result['text'] for thread in threads[1:]], ['cached 1', 'cached 2'])
+        self.assertEqual(batch.threads, threads[:1])
+        self.assertEqual(batch.data['messages'], [threads[0].data['messages']])
+        threads[0].cache_result({'text': 'cached 0'})
+        threads = [self.bench.thread('bench_complete', 'openai/chat_completions', 'batched {}'.format(i))
+            for i in range(3)]
+        finished = [self.wait(thread) for thread in threads]
+        for thread in threads:
+            thread.cache_policy = {}
+        self.bench.dispatcher.submit_batch(threads)
+        for event in finished:
+            self.assertTrue(event.wait(5))
+        self.assertEqual([thread.result['text'] for thread in threads], ['cached 0', 'cached 1', 'cached 2'])
+
+class TestDispatcher(RequestsTestCase):
+    latency = '0.3'
+
+    def test_interactive_skips_background_connections(self):
+        endpoint = self.settings.endpoints['openai/chat_completions']
+        endpoint.max_connections = 4
+        background = [self.bench.thread('bench_complete', 'openai/chat_completions', 'background {}'.format(i))
+            for i in range(8)]
+        for thread in background:
+            self.addCleanup(self.wait(thread).wait, 10)
+            self.bench.dispatcher.submit(thread, priority='background')
+        # background requests fill the connections of the server, but the interactive and chained ones
+        self.assertEqual(self.bench.dispatcher.counts(), (2, 6))
+        thread = self.bench.thread('bench_complete', 'openai/chat_completions', 'interactive')
+        self.bench.run([thread])
+        self.assertLess(thread.metrics['queue'], 0.1)
+
+class TestAsyncEngine(RequestsTestCase):
+    engine = 'asyncio'
+
+    def test_cancelled_before_started(self):
+        for i in range(10):
+            thread = self.bench.thread('bench_complete', 'openai/chat_completions', 'cancelled {}'.format(i))
+            finished = self.wait(thread)
+            self.bench.dispatcher.submit(thread)
+            self.bench.dispatcher.cancel(thread)
+            self.assertTrue(finished.wait(5))
+            self.assertIn('cancelled', str(thread.result['error']))
+        self.assertEqual(self.bench.dispatcher.counts(), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()